@@ -0,0 +1,314 @@
+"""Reproducible benchmarks of the AVIF converter.
+
+    python benchmark.py encode --output encode.json
+    python benchmark.py load --gcs --concurrency 8 --output load.json
+    python benchmark.py compare baseline.json current.json
+
+The results are JSON, so a run can be compared against a stored baseline
+to flag regressions.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import threading
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import requests
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+TEST_IMAGES_DIR = os.path.join(APP_DIR, "..", "test_images")
+STATIC_DIR = os.path.join(APP_DIR, "static")
+CORPUS_EXTENSIONS = (".avif", ".gif", ".heic", ".jpg", ".pdf", ".png", ".tif")
+DEFAULT_QUALITIES = ["30", "50", "70", "90"]
+EMULATOR_HOST = "localhost"
+EMULATOR_PORT = 9023
+EMULATOR_BUCKET = "benchmark"
+
+# Metrics where a larger value is better. Everything else is a latency.
+HIGHER_IS_BETTER = ("images_per_s", "mb_per_s", "rps")
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def corpus():
+    """Returns the benchmark images, sorted by path."""
+    files = []
+    for directory in (TEST_IMAGES_DIR, STATIC_DIR):
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(CORPUS_EXTENSIONS):
+                files.append(os.path.join(directory, name))
+    return files
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a list of numbers."""
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(latencies):
+    """Latency statistics in milliseconds."""
+    return {
+        "min_ms": min(latencies) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def metadata():
+    import main
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": main.available_cpus(),
+        "encoder": main.ENCODER,
+        "encode_concurrency": main.scheduler.slots.count,
+    }
+
+
+def bench_encode(files, qualities, repeat):
+    """Encode latency and throughput per file and quality."""
+    import main
+
+    results = []
+    for filename in files:
+        size = os.path.getsize(filename)
+        for quality in qualities:
+            name = os.path.relpath(filename, os.path.join(APP_DIR, ".."))
+            entry = {"file": name, "quality": quality, "input_bytes": size}
+            latencies = []
+            try:
+                for _ in range(repeat):
+                    start = perf_counter()
+                    result = main.encoder.encode(filename, quality)
+                    latencies.append(perf_counter() - start)
+            except Exception as error:
+                entry["error"] = str(error)
+                results.append(entry)
+                print("{} q={}: {}".format(name, quality, error), file=sys.stderr)
+                continue
+            entry.update(summarize(latencies))
+            entry["format"] = result.mime
+            entry["output_bytes"] = len(result.data)
+            entry["images_per_s"] = 1 / statistics.mean(latencies)
+            entry["mb_per_s"] = size / statistics.mean(latencies) / 10**6
+            results.append(entry)
+            print(
+                "{file} q={quality}: {p50_ms:.1f} ms".format(**entry), file=sys.stderr
+            )
+    return results
+
+
+def bench_load(files, qualities, concurrency, count, unique):
+    """Concurrent end-to-end requests against the app.
+
+    The images are served by a local origin server, and the app is run
+    with a threaded WSGI server.
+    """
+    from werkzeug.serving import make_server
+
+    import main
+
+    root = os.path.join(APP_DIR, "..")
+    handler = partial(QuietHandler, directory=root)
+    origin = ThreadingHTTPServer(("localhost", 0), handler)
+    server = make_server("localhost", 0, main.app, threaded=True)
+    threads = [
+        threading.Thread(target=origin.serve_forever),
+        threading.Thread(target=server.serve_forever),
+    ]
+    for thread in threads:
+        thread.start()
+    origin_url = "http://localhost:{}/".format(origin.server_port)
+    app_url = "http://localhost:{}/api".format(server.server_port)
+    urls = []
+    for i in range(count):
+        path = os.path.relpath(files[i % len(files)], root).replace(os.sep, "/")
+        url = origin_url + path
+        if unique:
+            url += "?n={}".format(i)
+        params = {"url": url, "quality": qualities[i % len(qualities)]}
+        urls.append(app_url + "?" + urllib.parse.urlencode(params))
+    sessions = threading.local()
+
+    def fetch(url):
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        start = perf_counter()
+        response = sessions.session.get(url)
+        return perf_counter() - start, response.status_code
+
+    try:
+        start = perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            responses = list(executor.map(fetch, urls))
+        elapsed = perf_counter() - start
+    finally:
+        server.shutdown()
+        origin.shutdown()
+        for thread in threads:
+            thread.join()
+        server.server_close()
+        origin.server_close()
+    statuses = {}
+    for _latency, status in responses:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    result = {
+        "concurrency": concurrency,
+        "requests": count,
+        "unique_urls": unique,
+        "statuses": statuses,
+        "rps": count / elapsed,
+    }
+    result.update(summarize([latency for latency, _status in responses]))
+    return result
+
+
+def flatten(results):
+    """Comparable metrics of a result document by name."""
+    metrics = {}
+    for entry in results.get("encode", []):
+        if "error" in entry:
+            continue
+        prefix = "encode/{}/q{}/".format(entry["file"], entry["quality"])
+        for key in ("p50_ms", "mb_per_s"):
+            metrics[prefix + key] = entry[key]
+    if "load" in results:
+        for key in ("p50_ms", "p95_ms", "p99_ms", "rps"):
+            metrics["load/" + key] = results["load"][key]
+    return metrics
+
+
+def compare(baseline, current, threshold):
+    """Returns the metrics that are worse than the baseline by more than the threshold."""
+    baseline, current = flatten(baseline), flatten(current)
+    regressions = []
+    for name in sorted(baseline.keys() & current.keys()):
+        before, after = baseline[name], current[name]
+        if not before:
+            continue
+        change = (after - before) / before
+        if name.endswith(HIGHER_IS_BETTER):
+            change = -change
+        if change > threshold:
+            regressions.append(
+                {"metric": name, "baseline": before, "current": after, "change": change}
+            )
+    return regressions
+
+
+def start_emulator():
+    """Starts an in-memory Cloud Storage emulator for the app's cache."""
+    from gcp_storage_emulator.server import create_server
+
+    os.environ["STORAGE_EMULATOR_HOST"] = "http://{}:{}".format(
+        EMULATOR_HOST, EMULATOR_PORT
+    )
+    os.environ["GCP_BUCKET"] = EMULATOR_BUCKET
+    server = create_server(
+        EMULATOR_HOST, EMULATOR_PORT, in_memory=True, default_bucket=EMULATOR_BUCKET
+    )
+    server.start()
+    return server
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in ("encode", "load"):
+        command = commands.add_parser(name)
+        command.add_argument("--output", help="write the JSON results to a file")
+        command.add_argument(
+            "--quality",
+            action="append",
+            help="quality values to sweep, can be repeated",
+        )
+        command.add_argument("--files", nargs="+", help="images instead of the corpus")
+    commands.choices["encode"].add_argument(
+        "--repeat", type=int, default=3, help="encodes per file and quality"
+    )
+    load = commands.choices["load"]
+    load.add_argument("--concurrency", type=int, default=4)
+    load.add_argument("--requests", type=int, default=100)
+    load.add_argument(
+        "--gcs", action="store_true", help="cache in a Cloud Storage emulator"
+    )
+    load.add_argument("--unique-urls", action="store_true", help="defeat the URL cache")
+    diff = commands.add_parser("compare")
+    diff.add_argument("baseline")
+    diff.add_argument("current")
+    diff.add_argument(
+        "--threshold", type=float, default=0.1, help="allowed relative change"
+    )
+    return parser.parse_args(args)
+
+
+def run(args=None):
+    args = parse_args(args)
+    if args.command == "compare":
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        with open(args.current) as file:
+            current = json.load(file)
+        regressions = compare(baseline, current, args.threshold)
+        json.dump(regressions, sys.stdout, indent=2)
+        print()
+        return 1 if regressions else 0
+    emulator = start_emulator() if args.command == "load" and args.gcs else None
+    # A disk tier left over from an earlier run would serve the images.
+    disk_cache = TemporaryDirectory()
+    os.environ["DISK_CACHE_DIR"] = disk_cache.name
+    try:
+        # The app configures itself from the environment when it's imported.
+        import main
+
+        logging.disable(logging.INFO)
+        files = args.files or corpus()
+        qualities = args.quality or DEFAULT_QUALITIES
+        results = {"meta": metadata()}
+        if args.command == "encode":
+            results["encode"] = bench_encode(files, qualities, args.repeat)
+        else:
+            results["meta"]["cache"] = type(main.cache).__name__
+            if isinstance(main.cache, main.TieredCache):
+                results["meta"]["cache_tiers"] = [
+                    name for name, _cache in main.cache.tiers
+                ]
+            results["load"] = bench_load(
+                files, qualities, args.concurrency, args.requests, args.unique_urls
+            )
+    finally:
+        if emulator is not None:
+            emulator.stop()
+        disk_cache.cleanup()
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
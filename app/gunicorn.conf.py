@@ -0,0 +1,25 @@
+"""Gunicorn settings, and hooks for collecting Prometheus metrics from all
+the workers."""
+
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+# "gevent" serves many slow fetches and cache reads per worker process.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+
+
+def on_starting(server):
+    """Removes the metrics of a previous run."""
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+
+def child_exit(server, worker):
+    """Drops the live gauges of a worker that exited."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,22 +1,41 @@
 """This app converts images to AV1 Image File Format (AVIF)."""
 
+import fcntl
+import gzip
+import json
 import logging
+import math
+import mimetypes
 import os
+import pickle
 import re
+import shutil
+import struct
+import sys
+import zipfile
 
 from base64 import b64encode
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from hashlib import sha256, sha384
-from io import BytesIO
-from subprocess import CalledProcessError, run
-from tempfile import NamedTemporaryFile
-from time import perf_counter
-from urllib.parse import urljoin
+from io import BytesIO, RawIOBase
+from subprocess import CalledProcessError, TimeoutExpired, run
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile, gettempdir
+from threading import Event, Lock, local
+from time import perf_counter, sleep, time
+from urllib.parse import parse_qsl, urljoin, urlsplit
+from uuid import uuid4
 
 import requests
 
 from flask import (
     Flask,
+    Request,
     abort,
+    g,
+    has_request_context,
+    jsonify,
     redirect,
     render_template,
     request,
@@ -24,42 +43,1845 @@ from flask import (
     send_from_directory,
     url_for,
 )
+from flask_caching.backends.base import BaseCache
 from flask_caching.backends.nullcache import NullCache
-from flask_caching.contrib.googlecloudstoragecache import GoogleCloudStorageCache
 from flask_talisman import Talisman
+from PIL import Image, ImageMath
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+from requests.adapters import HTTPAdapter
+from werkzeug.exceptions import HTTPException, RequestedRangeNotSatisfiable
 from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.wsgi import wrap_file
 
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 100))
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 100 * 1024 * 1024))
 CACHE_TIMEOUT = int(os.environ.get("CACHE_TIMEOUT", 43200))
+CACHE_URL = os.environ.get("CACHE_URL")
+DEFAULT_DEPTH = os.environ.get("DEFAULT_DEPTH")
+DEFAULT_PRESET = os.environ.get("DEFAULT_PRESET")
 DEFAULT_QUALITY = os.environ.get("DEFAULT_QUALITY", "50")
+DEFAULT_SPEED = os.environ.get("DEFAULT_SPEED")
+DEFAULT_SUBSAMPLING = os.environ.get("DEFAULT_SUBSAMPLING")
+DEFAULT_TILE_COLS = os.environ.get("DEFAULT_TILE_COLS")
+DEFAULT_TILE_ROWS = os.environ.get("DEFAULT_TILE_ROWS")
+DISK_CACHE_DIR = os.environ.get(
+    "DISK_CACHE_DIR", os.path.join(gettempdir(), "avif-converter")
+)
+DISK_CACHE_SIZE = int(os.environ.get("DISK_CACHE_SIZE", 512 * 1024 * 1024))
+ENCODER = os.environ.get("ENCODER", "pillow")
+ENCODE_CONCURRENCY = int(os.environ.get("ENCODE_CONCURRENCY", 0))
+ENCODE_DISK_LIMIT = os.environ.get("ENCODE_DISK_LIMIT", "1GiB")
+ENCODE_MEMORY_LIMIT = os.environ.get("ENCODE_MEMORY_LIMIT", "512MiB")
+ENCODE_QUEUE_SIZE = int(os.environ.get("ENCODE_QUEUE_SIZE", 16))
+ENCODE_QUEUE_TIMEOUT = float(os.environ.get("ENCODE_QUEUE_TIMEOUT", 30.0))
+ENCODE_THREADS = int(os.environ.get("ENCODE_THREADS", 0))
+ENCODE_TIME_LIMIT = int(os.environ.get("ENCODE_TIME_LIMIT", 120))
 FORCE_HTTPS = bool(os.environ.get("FORCE_HTTPS", ""))
 GCP_BUCKET = os.environ.get("GCP_BUCKET")
 GET_MAX_SIZE = int(os.environ.get("GET_MAX_SIZE", 20 * 1024 * 1024))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", 64))
+JOB_TIMEOUT = int(os.environ.get("JOB_TIMEOUT", 86400))
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", os.cpu_count() or 1))
+LOCAL_CACHE_TIMEOUT = int(os.environ.get("LOCAL_CACHE_TIMEOUT", 3600))
+LOCK_DIR = os.environ.get(
+    "LOCK_DIR", os.path.join(gettempdir(), "avif-converter-locks")
+)
 MAX_AGE = int(os.environ.get("MAX_AGE", CACHE_TIMEOUT))
+MAX_FRAMES = int(os.environ.get("MAX_FRAMES", 1000))
+MAX_MEGAPIXELS = float(os.environ.get("MAX_MEGAPIXELS", 100))
+MAX_PAGES = int(os.environ.get("MAX_PAGES", 100))
+NEGATIVE_CACHE_TIMEOUT = int(os.environ.get("NEGATIVE_CACHE_TIMEOUT", 60))
+MEMORY_CACHE_ITEM_SIZE = int(os.environ.get("MEMORY_CACHE_ITEM_SIZE", 1024 * 1024))
+MEMORY_CACHE_SIZE = int(os.environ.get("MEMORY_CACHE_SIZE", 64 * 1024 * 1024))
+POST_MAX_SIZE = int(os.environ.get("POST_MAX_SIZE", GET_MAX_SIZE))
 REMOTE_REQUEST_TIMEOUT = float(os.environ.get("REMOTE_REQUEST_TIMEOUT", 10.0))
+REMOTE_CONNECT_TIMEOUT = float(
+    os.environ.get("REMOTE_CONNECT_TIMEOUT", REMOTE_REQUEST_TIMEOUT)
+)
+REMOTE_HOST_CONCURRENCY = int(os.environ.get("REMOTE_HOST_CONCURRENCY", 4))
+REMOTE_POOL_SIZE = int(os.environ.get("REMOTE_POOL_SIZE", 16))
+REMOTE_READ_TIMEOUT = float(
+    os.environ.get("REMOTE_READ_TIMEOUT", REMOTE_REQUEST_TIMEOUT)
+)
+SEARCH_MAX_PROBES = int(os.environ.get("SEARCH_MAX_PROBES", 7))
+SEARCH_TOLERANCE = float(os.environ.get("SEARCH_TOLERANCE", 0.05))
+SERVE_CACHED = bool(os.environ.get("SERVE_CACHED", ""))
+SINGLE_FLIGHT_TIMEOUT = float(os.environ.get("SINGLE_FLIGHT_TIMEOUT", 120.0))
+SPOOL_MAX_SIZE = int(os.environ.get("SPOOL_MAX_SIZE", 1024 * 1024))
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 256 * 1024))
 TITLE = os.environ.get("TITLE", "AVIF Converter")
 URL = os.environ.get("URL")
+URL_MAX_AGE = int(os.environ.get("URL_MAX_AGE", 3600))
+WARM_UP = bool(os.environ.get("WARM_UP", ""))
+WIDTHS_MAX = int(os.environ.get("WIDTHS_MAX", 8))
 X_FOR = int(os.environ.get("X_FOR", 0))
 X_PROTO = int(os.environ.get("X_PROTO", 0))
 
 # "image/*" are always supported.
 SUPPORTED_MIMES = ["application/octet-stream", "application/pdf"]
+# Request parameters that choose the quality. At most one is allowed.
+QUALITY_PARAMS = ("quality", "max_bytes", "target_ssim")
+WIDTH_PARAMS = ("width", "widths")
+# Encoder options, in the order they're appended to the quality.
+ENCODER_OPTIONS = ("speed", "tile_rows", "tile_cols", "subsampling", "depth")
+OPTION_PARAMS = ("preset",) + ENCODER_OPTIONS
+PRESETS = {
+    # Interactive requests: a fast encoder speed and 2x2 tiles.
+    "fast": {"speed": "9", "tile_rows": "1", "tile_cols": "1"},
+    # Batches: a slow encoder speed and full chroma resolution.
+    "archive": {"speed": "2", "subsampling": "4:4:4"},
+}
+# Valid values of the encoder options. Numbers are normalized before checking.
+OPTION_CHOICES = {
+    "speed": [str(speed) for speed in range(11)],
+    "tile_rows": [str(tiles) for tiles in range(7)],
+    "tile_cols": [str(tiles) for tiles in range(7)],
+    "subsampling": ("4:2:0", "4:2:2", "4:4:4"),
+    "depth": ("8", "10", "12"),
+}
+if DEFAULT_PRESET and DEFAULT_PRESET not in PRESETS:
+    raise ValueError("Unknown DEFAULT_PRESET: {}".format(DEFAULT_PRESET))
+for _option, _value in zip(
+    ENCODER_OPTIONS,
+    (
+        DEFAULT_SPEED,
+        DEFAULT_TILE_ROWS,
+        DEFAULT_TILE_COLS,
+        DEFAULT_SUBSAMPLING,
+        DEFAULT_DEPTH,
+    ),
+):
+    if _value is not None and _value not in OPTION_CHOICES[_option]:
+        raise ValueError("Invalid DEFAULT_{}: {}".format(_option.upper(), _value))
+# Static files served from fingerprinted URLs.
+STATIC_ASSETS = ("javascript.js", "style.css")
+ASSET_MAX_AGE = 365 * 24 * 3600
 
 
 # Change the format of messages logged to Stackdriver
 logging.basicConfig(format="%(message)s", level=logging.INFO)
+# Pillow warns about images over the budget and refuses twice as large ones.
+Image.MAX_IMAGE_PIXELS = int(MAX_MEGAPIXELS * 10**6)
+
+TIME_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+cache_lookups = Counter(
+    "avif_cache_lookups", "Cache lookups by key kind and result.", ["kind", "result"]
+)
+cache_tier_lookups = Counter(
+    "avif_cache_tier_lookups", "Cache lookups by tier and result.", ["tier", "result"]
+)
+compression_ratio = Histogram(
+    "avif_compression_ratio",
+    "Input size divided by the AVIF size.",
+    ["format"],
+    buckets=(0.5, 1, 2, 4, 8, 16, 32, 64, 128),
+)
+encode_queue_seconds = Histogram(
+    "avif_encode_queue_seconds",
+    "Time spent waiting for an encode slot.",
+    buckets=TIME_BUCKETS,
+)
+encode_seconds = Histogram(
+    "avif_encode_seconds", "Encoding time.", ["format", "quality"], buckets=TIME_BUCKETS
+)
+encodes_in_progress = Gauge(
+    "avif_encodes_in_progress", "Encodes in progress.", multiprocess_mode="livesum"
+)
+errors = Counter(
+    "avif_errors", "Error responses and failed jobs by status code.", ["code"]
+)
+fetch_seconds = Histogram(
+    "avif_fetch_seconds",
+    "Time spent downloading remote images.",
+    ["format", "quality"],
+    buckets=TIME_BUCKETS,
+)
+input_bytes = Counter("avif_input_bytes", "Size of the encoded inputs.", ["format"])
+origin_requests = Counter(
+    "avif_origin_requests",
+    "Requests to the origins by whether they got a host slot.",
+    ["result"],
+)
+origin_revalidations = Counter(
+    "avif_origin_revalidations",
+    "Conditional requests to the origins by result.",
+    ["result"],
+)
+output_bytes = Counter("avif_output_bytes", "Size of the AVIF outputs.", ["format"])
+probe_seconds = Histogram(
+    "avif_probe_seconds",
+    "Time spent identifying the input format.",
+    ["format", "quality"],
+    buckets=TIME_BUCKETS,
+)
+request_seconds = Histogram(
+    "avif_request_seconds",
+    "Request latency.",
+    ["endpoint", "format", "quality"],
+    buckets=TIME_BUCKETS,
+)
+# Fetch times are kept per thread until the format of the image is known.
+conversion = local()
+
+
+class MemoryCache(BaseCache):
+    """A size-bounded in-process LRU cache for small objects.
+
+    :param max_size: Total size of the stored values in bytes.
+    :param max_item_size: Values larger than this are not stored.
+    """
+
+    def __init__(self, max_size, max_item_size, default_timeout=300):
+        super().__init__(default_timeout)
+        self.max_size = max_size
+        self.max_item_size = max_item_size
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires, value, _size = item
+            if expires and expires < time():
+                self._remove(key)
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        size = _sizeof(value)
+        if size > self.max_item_size:
+            self.delete(key)
+            return False
+        timeout = self._normalize_timeout(timeout)
+        expires = time() + timeout if timeout else 0
+        with self._lock:
+            self._remove(key)
+            self._items[key] = (expires, value, size)
+            self._size += size
+            while self._size > self.max_size:
+                _key, (_expires, _value, evicted) = self._items.popitem(last=False)
+                self._size -= evicted
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def open(self, key):
+        """Returns a binary file object and the size of a bytes value."""
+        value = self.get(key)
+        if not isinstance(value, bytes):
+            return None
+        return BytesIO(value), len(value)
+
+    def delete(self, key):
+        with self._lock:
+            return self._remove(key)
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+        return True
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is None:
+            return False
+        self._size -= item[2]
+        return True
+
+
+class FileSlice(RawIOBase):
+    """A read-only view of a file from ``offset`` on, ``size`` bytes long."""
+
+    def __init__(self, file, offset, size):
+        super().__init__()
+        self._file = file
+        self._offset = offset
+        self._size = size
+        self._position = 0
+        file.seek(offset)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        view = memoryview(buffer)[: max(0, self._size - self._position)]
+        count = self._file.readinto(view)
+        self._position += count
+        return count
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._position = max(0, min(offset, self._size))
+        self._file.seek(self._offset + self._position)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class DiskCache(BaseCache):
+    """A local directory cache with byte-based LRU or LFU eviction.
+
+    Every entry is a file that starts with an expiry timestamp, a type flag
+    and a hit count. Files are replaced atomically, so several worker
+    processes on the same host can share the directory. A read touches the
+    modification time and, with the ``lfu`` policy, increments the hit
+    count. When the directory grows over ``max_size`` bytes, the least
+    recently or the least frequently used files are removed.
+
+    Other processes write to the directory too, so its size is read again
+    whenever this process has written a tenth of ``max_size`` since the
+    last reading. The directory may exceed the limit by that much per
+    process between the readings.
+    """
+
+    _header = struct.Struct(">dcI")
+    rescan_ratio = 0.1
+
+    def __init__(self, directory, max_size, default_timeout=300, policy="lru"):
+        super().__init__(default_timeout)
+        if policy not in ("lru", "lfu"):
+            raise ValueError("Unknown eviction policy: {}".format(policy))
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_size = max_size
+        self.policy = policy
+        self._size = sum(entry.stat().st_size for entry in self._entries())
+        self._written = 0
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, "rb") as file:
+                expires, flag, _hits = self._header.unpack(file.read(self._header.size))
+                if expires and expires < time():
+                    file.close()
+                    self._unlink(filename)
+                    return None
+                value = file.read()
+            self._touch(filename)
+        except (OSError, struct.error):
+            return None
+        return value if flag == b"b" else pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        expires = time() + timeout if timeout else 0
+        if isinstance(value, bytes):
+            flag, payload = b"b", value
+        else:
+            flag, payload = b"p", pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        filename = self._filename(key)
+        try:
+            with NamedTemporaryFile(dir=self.directory, delete=False) as file:
+                file.write(self._header.pack(expires, flag, 0))
+                file.write(payload)
+            os.replace(file.name, filename)
+        except OSError:
+            logging.exception("Could not write to the disk cache")
+            return False
+        self._size += self._header.size + len(payload)
+        self._written += self._header.size + len(payload)
+        if (
+            self._size > self.max_size
+            or self._written > self.max_size * self.rescan_ratio
+        ):
+            self._evict()
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def open(self, key):
+        """Returns a binary file object and the size of a bytes value."""
+        filename = self._filename(key)
+        try:
+            file = open(filename, "rb")
+        except OSError:
+            return None
+        try:
+            expires, flag, _hits = self._header.unpack(file.read(self._header.size))
+            if flag != b"b" or expires and expires < time():
+                file.close()
+                return None
+            size = os.fstat(file.fileno()).st_size - self._header.size
+            self._touch(filename)
+        except (OSError, struct.error):
+            file.close()
+            return None
+        return FileSlice(file, self._header.size, size), size
+
+    def delete(self, key):
+        return self._unlink(self._filename(key))
+
+    def has(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, "rb") as file:
+                expires, _flag, _hits = self._header.unpack(
+                    file.read(self._header.size)
+                )
+        except (OSError, struct.error):
+            return False
+        return not expires or expires >= time()
+
+    def clear(self):
+        for entry in self._entries():
+            self._unlink(entry.path)
+        self._size = 0
+        return True
+
+    def _touch(self, filename):
+        if self.policy == "lfu":
+            # Concurrent readers may lose an increment, which is fine for
+            # an eviction order.
+            with open(filename, "r+b") as file:
+                expires, flag, hits = self._header.unpack(file.read(self._header.size))
+                file.seek(0)
+                file.write(self._header.pack(expires, flag, hits + 1))
+        os.utime(filename)
+
+    def _evict(self):
+        """Remove the least recently or frequently used files until the cache fits."""
+        entries = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+                hits = self._hits(entry.path) if self.policy == "lfu" else 0
+            except OSError:
+                continue
+            entries.append((hits, stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        self._size = sum(size for _hits, _mtime, size, _path in entries)
+        self._written = 0
+        for _hits, _mtime, size, path in entries:
+            if self._size <= self.max_size:
+                break
+            if self._unlink(path):
+                self._size -= size
+
+    def _hits(self, filename):
+        with open(filename, "rb") as file:
+            try:
+                return self._header.unpack(file.read(self._header.size))[2]
+            except struct.error:
+                return 0
+
+    def _entries(self):
+        with os.scandir(self.directory) as entries:
+            return [
+                entry
+                for entry in entries
+                if entry.is_file() and not entry.name.startswith("tmp")
+            ]
+
+    def _filename(self, key):
+        return os.path.join(self.directory, sha256(key.encode("utf-8")).hexdigest())
+
+    @staticmethod
+    def _unlink(filename):
+        try:
+            os.unlink(filename)
+        except OSError:
+            return False
+        return True
+
+
+class TieredCache(BaseCache):
+    """Chains caches from the fastest to the authoritative one.
+
+    Writes go through every tier and reads are promoted into the faster
+    tiers. The result of ``set`` is the acknowledgement of the last tier.
+
+    :param tiers: A list of ``(name, cache)`` tuples, the fastest first.
+    :param promote_size: Largest value promoted when it's opened as a stream.
+    """
+
+    def __init__(self, tiers, promote_size=0, default_timeout=300):
+        super().__init__(default_timeout)
+        self.tiers = tiers
+        self.promote_size = promote_size
+        self._hits = dict.fromkeys((name for name, _tier in tiers), 0)
+        self._misses = dict.fromkeys((name for name, _tier in tiers), 0)
+        self._lock = Lock()
+
+    def get(self, key):
+        for i, (name, tier) in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                self._count(self._hits, name)
+                for _name, upper in self.tiers[:i]:
+                    upper.set(key, value)
+                return value
+            self._count(self._misses, name)
+        return None
+
+    def set(self, key, value, timeout=None):
+        result = False
+        for i, (_name, tier) in enumerate(reversed(self.tiers)):
+            stored = tier.set(key, value, timeout)
+            if i == 0:
+                result = stored
+        return result
+
+    def add(self, key, value, timeout=None):
+        _name, backend = self.tiers[-1]
+        if not backend.add(key, value, timeout):
+            return False
+        for _name, tier in self.tiers[:-1]:
+            tier.set(key, value, timeout)
+        return True
+
+    def delete(self, key):
+        result = False
+        for _name, tier in self.tiers:
+            result = tier.delete(key)
+        return result
+
+    def has(self, key):
+        for name, tier in self.tiers:
+            if tier.has(key):
+                self._count(self._hits, name)
+                return True
+            self._count(self._misses, name)
+        return False
+
+    def open(self, key):
+        """Opens a bytes value from the first tier that has it.
+
+        Values up to ``promote_size`` bytes are read and promoted into the
+        faster tiers, larger ones are streamed from where they are.
+        """
+        for i, (name, tier) in enumerate(self.tiers):
+            stream = cache_open(tier, key)
+            if stream is None:
+                self._count(self._misses, name)
+                continue
+            self._count(self._hits, name)
+            file, size = stream
+            if i > 0 and size <= self.promote_size:
+                with file:
+                    value = file.read()
+                for _name, upper in self.tiers[:i]:
+                    upper.set(key, value)
+                return BytesIO(value), size
+            return stream
+        return None
+
+    def clear(self):
+        return all([tier.clear() for _name, tier in self.tiers])
+
+    def stats(self):
+        """Hit and miss counters per tier."""
+        with self._lock:
+            return {
+                name: {"hits": self._hits[name], "misses": self._misses[name]}
+                for name, _tier in self.tiers
+            }
+
+    def _count(self, counter, name):
+        with self._lock:
+            counter[name] += 1
+        result = "hit" if counter is self._hits else "miss"
+        cache_tier_lookups.labels(name, result).inc()
+
+
+class CloudStorageCache(BaseCache):
+    """Google Cloud Storage cache with an atomic ``add`` and streamed reads.
+
+    The rest is done by the Flask-Caching backend, which is imported with
+    the Cloud Storage client only when the cache is configured.
+    """
+
+    def __init__(self, bucket, key_prefix=None, default_timeout=300, **kwargs):
+        from flask_caching.contrib.googlecloudstoragecache import (
+            GoogleCloudStorageCache,
+        )
+        from google.cloud import exceptions
+
+        super().__init__(default_timeout)
+        self.cache = GoogleCloudStorageCache(
+            bucket, key_prefix, default_timeout, **kwargs
+        )
+        self.bucket = self.cache.bucket
+        self.key_prefix = self.cache.key_prefix
+        self._errors = exceptions
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, timeout=None):
+        return self.cache.set(key, value, timeout)
+
+    def delete(self, key):
+        return self.cache.delete(key)
+
+    def has(self, key):
+        return self.cache.has(key)
+
+    def clear(self):
+        return self.cache.clear()
+
+    def add(self, key, value, timeout=None):
+        full_key = self.key_prefix + key
+        if isinstance(value, bytes):
+            content_type = "application/octet-stream"
+        else:
+            value, content_type = json.dumps(value), "application/json"
+        for _attempt in range(2):
+            blob = self.bucket.blob(full_key)
+            timeout = self._normalize_timeout(timeout)
+            if timeout != 0:
+                blob.custom_time = self.cache._now(delta=timeout)
+            try:
+                blob.upload_from_string(
+                    value, content_type=content_type, if_generation_match=0
+                )
+                return True
+            except self._errors.PreconditionFailed:
+                if self.cache._has(full_key):
+                    return False
+                # The existing object is stale.
+                self.cache._delete(full_key)
+            except self._errors.TooManyRequests:
+                return False
+        return False
+
+    def open(self, key):
+        """Returns a binary file object and the size of a bytes value.
+
+        The object is downloaded in chunks with range requests as it's read.
+        """
+        blob = self.bucket.get_blob(self.key_prefix + key)
+        if blob is None or blob.content_type == "application/json":
+            return None
+        if blob.custom_time and self.cache._now() > blob.custom_time:
+            return None
+        return blob.open("rb", chunk_size=STREAM_CHUNK_SIZE), blob.size
+
+
+class S3Cache(BaseCache):
+    """A cache in an S3-compatible object store, like AWS S3 or MinIO.
+
+    Bytes are stored as they are and other values as JSON, with the expiry
+    time in the object metadata. ``add`` is a conditional write, so it's
+    atomic on stores that support ``If-None-Match``.
+    """
+
+    def __init__(self, bucket, key_prefix="", default_timeout=300, **kwargs):
+        # boto3 is only needed, and imported, when the store is configured.
+        import boto3
+
+        super().__init__(default_timeout)
+        self.bucket = bucket
+        self.key_prefix = key_prefix
+        self.client = boto3.client("s3", **kwargs)
+        self._errors = self.client.exceptions
+
+    def get(self, key):
+        response = self._get_object(key)
+        if response is None:
+            return None
+        with response["Body"] as body:
+            value = body.read()
+        if response.get("ContentType") == "application/json":
+            return json.loads(value)
+        return value
+
+    def set(self, key, value, timeout=None):
+        try:
+            self._put_object(key, value, timeout)
+        except self._errors.ClientError:
+            logging.exception("Could not write to the object store")
+            return False
+        return True
+
+    def add(self, key, value, timeout=None):
+        for _attempt in range(2):
+            try:
+                self._put_object(key, value, timeout, IfNoneMatch="*")
+                return True
+            except self._errors.ClientError as error:
+                if error.response["Error"]["Code"] not in (
+                    "PreconditionFailed",
+                    "ConditionalRequestConflict",
+                ):
+                    return False
+                if self.has(key):
+                    return False
+                # The existing object is stale.
+                self.delete(key)
+        return False
+
+    def open(self, key):
+        """Returns a binary file object and the size of a bytes value.
+
+        The object is streamed from the store as it's read.
+        """
+        response = self._get_object(key)
+        if response is None:
+            return None
+        if response.get("ContentType") == "application/json":
+            response["Body"].close()
+            return None
+        return response["Body"], response["ContentLength"]
+
+    def delete(self, key):
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=self.key_prefix + key)
+        except self._errors.ClientError:
+            return False
+        return True
+
+    def has(self, key):
+        try:
+            response = self.client.head_object(
+                Bucket=self.bucket, Key=self.key_prefix + key
+            )
+        except self._errors.ClientError:
+            return False
+        return not self._expired(response)
+
+    def clear(self):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.key_prefix):
+            for item in page.get("Contents", []):
+                self.client.delete_object(Bucket=self.bucket, Key=item["Key"])
+        return True
+
+    def _get_object(self, key):
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self.key_prefix + key
+            )
+        except self._errors.ClientError:
+            return None
+        if self._expired(response):
+            response["Body"].close()
+            return None
+        return response
+
+    def _put_object(self, key, value, timeout, **kwargs):
+        timeout = self._normalize_timeout(timeout)
+        metadata = {"expires": str(time() + timeout if timeout else 0)}
+        if isinstance(value, bytes):
+            body, content_type = value, "application/octet-stream"
+        else:
+            body, content_type = json.dumps(value).encode(), "application/json"
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self.key_prefix + key,
+            Body=body,
+            ContentType=content_type,
+            Metadata=metadata,
+            **kwargs,
+        )
+
+    @staticmethod
+    def _expired(response):
+        expires = float(response.get("Metadata", {}).get("expires", 0))
+        return bool(expires) and expires < time()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+def _same_file(file, filename):
+    # Whether an open file is still the file by the name.
+    try:
+        return os.path.samestat(os.fstat(file.fileno()), os.stat(filename))
+    except FileNotFoundError:
+        return False
+
+
+class SingleFlight:
+    """Lets one caller do the work for a key while the others wait for it.
+
+    Callers in the same process get the result of the first caller. Worker
+    processes on the same host are serialized with a lock file and other
+    instances with a lease object in a shared cache, after which they are
+    expected to find the result in that cache. The work function receives a
+    flag telling whether it had to wait, so it knows to check the cache.
+    Waiting is bounded by ``timeout`` seconds, after which the work is done
+    anyway.
+    """
+
+    def __init__(self, directory, timeout):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = Lock()
+
+    def do(self, key, func, shared_cache=None):
+        """Calls ``func(waited)`` once for concurrent callers of ``key``."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if not flight.done.wait(self.timeout):
+                return func(True)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            if shared_cache is None:
+                flight.result = func(False)
+            else:
+                with self._file_lock(key) as waited_lock:
+                    with self._lease(key, shared_cache) as waited_lease:
+                        flight.result = func(waited_lock or waited_lease)
+            return flight.result
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    @contextmanager
+    def _file_lock(self, key):
+        filename = os.path.join(self.directory, key + ".lock")
+        waited = False
+        locked = False
+        deadline = time() + self.timeout
+        while not locked:
+            file = open(filename, "a")
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                file.close()
+                if time() > deadline:
+                    logging.warning("Timed out waiting for lock %s", key)
+                    break
+                waited = True
+                sleep(0.05)
+                continue
+            if _same_file(file, filename):
+                locked = True
+            else:
+                # The previous holder removed the file before unlocking it,
+                # and a new holder may have locked a new file by the name.
+                file.close()
+                waited = True
+        try:
+            yield waited
+        finally:
+            if locked:
+                DiskCache._unlink(filename)
+                fcntl.flock(file, fcntl.LOCK_UN)
+                file.close()
+
+    @contextmanager
+    def _lease(self, key, shared_cache):
+        lease_key = key + ".lease"
+        waited = False
+        leased = False
+        deadline = time() + self.timeout
+        while not leased:
+            leased = shared_cache.add(lease_key, os.getpid(), int(self.timeout) + 1)
+            if not leased:
+                if time() > deadline:
+                    logging.warning("Timed out waiting for lease %s", key)
+                    break
+                waited = True
+                sleep(0.25)
+        try:
+            yield waited
+        finally:
+            if leased:
+                shared_cache.delete(lease_key)
+
+
+class LockSlots:
+    """A fixed number of slots shared by the processes on the same host.
+
+    Every slot is a lock file, so the kernel frees the slots of a process
+    that dies while holding them.
+    """
+
+    def __init__(self, prefix, count):
+        os.makedirs(os.path.dirname(prefix), exist_ok=True)
+        self.prefix = prefix
+        self.count = count
+
+    def try_acquire(self):
+        """Returns the locked slot file, or None if all slots are taken."""
+        for i in range(self.count):
+            file = open("{}.{}.slot".format(self.prefix, i), "a")
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                file.close()
+                continue
+            return file
+        return None
+
+    def acquire(self, timeout=None):
+        """Waits for a slot, at most ``timeout`` seconds if given."""
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            file = self.try_acquire()
+            if file is not None or deadline is not None and time() > deadline:
+                return file
+            sleep(0.05)
+
+    @staticmethod
+    def release(file):
+        fcntl.flock(file, fcntl.LOCK_UN)
+        file.close()
+
+    def in_use(self):
+        """Number of slots currently held by any process."""
+        held = 0
+        for i in range(self.count):
+            try:
+                with open("{}.{}.slot".format(self.prefix, i), "a") as file:
+                    fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    fcntl.flock(file, fcntl.LOCK_UN)
+            except BlockingIOError:
+                held += 1
+        return held
+
+
+class EncodeScheduler:
+    """Limits the concurrent encodes on the host to the available cores.
+
+    Requests that don't get an encode slot at once wait in a bounded queue.
+    If the queue is full, or the wait takes longer than ``timeout``
+    seconds, the request is rejected with 503 and a Retry-After header.
+    Background work waits without limits.
+    """
+
+    def __init__(self, directory, concurrency, queue_size, timeout):
+        self.slots = LockSlots(os.path.join(directory, "encode"), concurrency)
+        self.queue = LockSlots(os.path.join(directory, "queue"), queue_size)
+        self.timeout = timeout
+        self._encodes = 0
+        self._encode_time = 0.0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._rejected = 0
+        self._lock = Lock()
+
+    @contextmanager
+    def slot(self, background=False):
+        """Holds an encode slot."""
+        start = perf_counter()
+        file = self.slots.try_acquire()
+        if file is None and background:
+            file = self.slots.acquire()
+        elif file is None:
+            ticket = self.queue.try_acquire()
+            if ticket is not None:
+                try:
+                    file = self.slots.acquire(self.timeout)
+                finally:
+                    self.queue.release(ticket)
+            if file is None:
+                with self._lock:
+                    self._rejected += 1
+                logging.warning("Encoding queue is full")
+                abort(503, retry_after=self._retry_after())
+        wait_time = perf_counter() - start
+        logging.info("Encoding queue time: %.4f", wait_time)
+        encode_queue_seconds.observe(wait_time)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.slots.release(file)
+            with self._lock:
+                self._encodes += 1
+                self._encode_time += perf_counter() - start
+                self._waits += 1
+                self._wait_time += wait_time
+                self._max_wait_time = max(self._max_wait_time, wait_time)
+
+    def stats(self):
+        """Queue depth of the host and wait times of this process."""
+        with self._lock:
+            return {
+                "slots": self.slots.count,
+                "running": self.slots.in_use(),
+                "queued": self.queue.in_use(),
+                "encodes": self._encodes,
+                "rejected": self._rejected,
+                "wait_time_avg": self._wait_time / self._waits if self._waits else 0.0,
+                "wait_time_max": self._max_wait_time,
+            }
+
+    def _retry_after(self):
+        with self._lock:
+            average = self._encode_time / self._encodes if self._encodes else 1.0
+        return max(1, math.ceil(average * self.queue.count / self.slots.count))
+
+
+class OriginClient:
+    """A keep-alive HTTP client for fetching images from origins.
+
+    Connections are pooled per host. Concurrent fetches from one host are
+    limited to ``host_concurrency`` slots, which are lock files shared by
+    the worker processes on the same host. A fetch that doesn't get a slot
+    within the connect timeout is rejected with 503.
+    """
+
+    def __init__(self, directory, pool_size, host_concurrency, timeout):
+        self.directory = directory
+        self.host_concurrency = host_concurrency
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._requests = 0
+        self._rejected = 0
+        self._lock = Lock()
+
+    @contextmanager
+    def get(self, url, headers=None):
+        """Streams a GET request while holding a slot for the host."""
+        with self._host_slot(urlsplit(url).netloc):
+            with self.session.get(
+                url, headers=headers, timeout=self.timeout, stream=True
+            ) as response:
+                yield response
+
+    def stats(self):
+        """Request counters and connection pool statistics."""
+        pools = {}
+        for adapter in set(self.session.adapters.values()):
+            manager = adapter.poolmanager
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                pools["{}://{}:{}".format(pool.scheme, pool.host, pool.port)] = {
+                    "connections": pool.num_connections,
+                    "requests": pool.num_requests,
+                    "idle": pool.pool.qsize() if pool.pool else 0,
+                }
+        with self._lock:
+            return {
+                "requests": self._requests,
+                "rejected": self._rejected,
+                "pools": pools,
+            }
+
+    @contextmanager
+    def _host_slot(self, host):
+        slots = LockSlots(
+            os.path.join(self.directory, sha256(host.encode()).hexdigest()[:32]),
+            self.host_concurrency,
+        )
+        file = slots.acquire(self.timeout[0])
+        if file is None:
+            with self._lock:
+                self._rejected += 1
+            origin_requests.labels("rejected").inc()
+            logging.warning("Too many concurrent requests to %s", host)
+            abort(503, retry_after=max(1, int(self.timeout[0])))
+        with self._lock:
+            self._requests += 1
+        origin_requests.labels("accepted").inc()
+        try:
+            yield
+        finally:
+            slots.release(file)
+
+
+class SchedulerCollector:
+    """Exports the encode slots and the queue depth of the host."""
+
+    def collect(self):
+        stats = scheduler.stats()
+        yield GaugeMetricFamily(
+            "avif_encode_slots", "Encode slots of the host.", value=stats["slots"]
+        )
+        yield GaugeMetricFamily(
+            "avif_encode_slots_in_use",
+            "Encode slots in use on the host.",
+            value=stats["running"],
+        )
+        yield GaugeMetricFamily(
+            "avif_encode_queue_depth",
+            "Requests waiting for an encode slot on the host.",
+            value=stats["queued"],
+        )
+
+
+class OriginCollector:
+    """Exports the connection pools of the worker process serving the scrape."""
+
+    def collect(self):
+        pools = origin.stats()["pools"]
+        for name, documentation, key in (
+            (
+                "avif_origin_pool_connections",
+                "Connections opened to the origin by this worker.",
+                "connections",
+            ),
+            (
+                "avif_origin_pool_requests",
+                "Requests sent over the pooled connections of this worker.",
+                "requests",
+            ),
+            ("avif_origin_pool_idle", "Idle connections of this worker.", "idle"),
+        ):
+            family = GaugeMetricFamily(name, documentation, labels=["pool"])
+            for pool, stats in pools.items():
+                family.add_metric([pool], stats[key])
+            yield family
+
+
+class JobQueue:
+    """Runs conversion jobs in the background and keeps their records.
+
+    Jobs are run in threads, which fetch and hash the input, and the
+    encoding itself is done in a bounded process pool. The records are
+    stored in the cache, so any worker sharing the cache can answer polls.
+    """
+
+    def __init__(self, workers, queue_size, timeout):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._pending = 0
+        self._threads = None
+        self._processes = None
+        self._lock = Lock()
+
+    def submit(self, func, *args):
+        """Creates a job record and queues ``func(process_pool, *args)``."""
+        with self._lock:
+            if self._pending >= self.queue_size:
+                return None
+            self._pending += 1
+            if self._threads is None:
+                self._threads = ThreadPoolExecutor(max_workers=self.queue_size)
+        job = {"id": uuid4().hex, "status": "pending", "created": int(time())}
+        self.save(job)
+        # The thread updates its record while the initial one is answered.
+        record = dict(job)
+        self._threads.submit(self._run, job, func, *args)
+        return record
+
+    def process_pool(self):
+        """The process pool used for encoding, created on first use."""
+        with self._lock:
+            if self._processes is None:
+                self._processes = ProcessPoolExecutor(max_workers=self.workers)
+            return self._processes
+
+    def get(self, job_id):
+        # Job records change, so copies in the local tiers of a worker would
+        # go stale. They're kept only in the shared backend.
+        return _authoritative_cache().get("job-" + job_id)
+
+    def save(self, job):
+        _authoritative_cache().set("job-" + job["id"], job, self.timeout)
+
+    def _run(self, job, func, *args):
+        try:
+            job["status"] = "running"
+            self.save(job)
+            job["image"] = func(self.process_pool(), *args)
+            job["status"] = "done"
+        except HTTPException as error:
+            job["status"] = "failed"
+            job["error"] = error.code
+        except Exception:
+            logging.exception("Job %s failed", job["id"])
+            job["status"] = "failed"
+            job["error"] = 500
+        finally:
+            with self._lock:
+                self._pending -= 1
+        if job["status"] == "failed":
+            errors.labels(job["error"]).inc()
+        self.save(job)
+
+
+def cache_open(backend, key):
+    """Opens a bytes value as a binary file object and returns it with its size.
+
+    Backends without a streaming read path load the whole value.
+    """
+    if hasattr(backend, "open"):
+        return backend.open(key)
+    value = backend.get(key)
+    if not isinstance(value, bytes):
+        return None
+    return BytesIO(value), len(value)
+
+
+def create_cache():
+    """Local memory and disk tiers in front of the configured backend.
+
+    The backend is chosen with CACHE_URL, or with GCP_BUCKET for Cloud
+    Storage. Without either, nothing is cached.
+    """
+    url = CACHE_URL or (GCP_BUCKET and "gs://" + GCP_BUCKET)
+    if not url:
+        return NullCache()
+    backend = create_backend(url)
+    tiers = []
+    if MEMORY_CACHE_SIZE > 0:
+        tiers.append(
+            (
+                "memory",
+                MemoryCache(
+                    MEMORY_CACHE_SIZE,
+                    MEMORY_CACHE_ITEM_SIZE,
+                    default_timeout=LOCAL_CACHE_TIMEOUT,
+                ),
+            )
+        )
+    if DISK_CACHE_SIZE > 0 and not isinstance(backend[1], DiskCache):
+        tiers.append(
+            (
+                "disk",
+                DiskCache(
+                    DISK_CACHE_DIR, DISK_CACHE_SIZE, default_timeout=LOCAL_CACHE_TIMEOUT
+                ),
+            )
+        )
+    tiers.append(backend)
+    return TieredCache(
+        tiers, promote_size=MEMORY_CACHE_ITEM_SIZE, default_timeout=MAX_AGE
+    )
+
+
+def create_backend(url):
+    """Returns the name and the cache of a CACHE_URL.
+
+    ``file:///path?max_size=bytes&policy=lru|lfu``, ``redis://host:port/db``,
+    ``s3://bucket/prefix?endpoint_url=http://host:port`` and
+    ``gs://bucket/prefix`` are supported.
+    """
+    parts = urlsplit(url)
+    options = dict(parse_qsl(parts.query))
+    prefix = parts.path.lstrip("/")
+    if parts.scheme == "file":
+        return (
+            "file",
+            DiskCache(
+                parts.path,
+                int(options.get("max_size", DISK_CACHE_SIZE)),
+                default_timeout=MAX_AGE,
+                policy=options.get("policy", "lru"),
+            ),
+        )
+    if parts.scheme in ("redis", "rediss", "unix"):
+        # The Redis client is only needed, and imported, when it's configured.
+        import redis
+        from flask_caching.backends.rediscache import RedisCache
+
+        client = redis.Redis.from_url(url)
+        return ("redis", RedisCache(client, default_timeout=MAX_AGE, key_prefix=""))
+    if parts.scheme == "s3":
+        return (
+            "s3",
+            S3Cache(parts.netloc, prefix, default_timeout=MAX_AGE, **options),
+        )
+    if parts.scheme == "gs":
+        return (
+            "gcs",
+            CloudStorageCache(
+                bucket=parts.netloc, key_prefix=prefix, default_timeout=MAX_AGE
+            ),
+        )
+    raise ValueError("Unsupported CACHE_URL: {}".format(url))
+
+
+class EncoderError(Exception):
+    """The image could not be converted to AVIF."""
+
+
+class ImageTooLarge(EncoderError):
+    """The image is over the pixel, frame or page budget."""
+
+
+Encoded = namedtuple("Encoded", ["mime", "data", "probe_time", "quality"])
+Asset = namedtuple("Asset", ["name", "sri", "mimetype", "variants"])
+QualityTarget = namedtuple("QualityTarget", ["metric", "value"])
+
+
+class MagickEncoder:
+    """Encodes images with the ImageMagick command line tool."""
+
+    name = "magick"
+
+    def __init__(self, threads=None):
+        self.threads = threads
+
+    def encode(self, source, quality=None):
+        """Returns the source format, the AVIF bytes, the probe time and the quality.
+
+        The source is a filename or a binary file object.
+        """
+        return self.encode_variants(source, [(None, quality)])[0]
+
+    def encode_variants(self, source, variants):
+        """Encodes a list of (width, quality) variants of the source.
+
+        A width of None keeps the original size. If there are several
+        variants or the quality is searched, the source is decoded only once.
+        """
+        if not isinstance(source, str):
+            with NamedTemporaryFile() as tempf:
+                shutil.copyfileobj(source, tempf)
+                tempf.flush()
+                return self.encode_variants(tempf.name, variants)
+        start = perf_counter()
+        mime = self._probe(source)
+        probe_time = perf_counter() - start
+        logging.info("Converting %s to AVIF", mime)
+        if len(variants) == 1:
+            width, quality = variants[0]
+            if quality_target(quality) is None:
+                data = self._convert(
+                    source + "[0]", mime, *split_options(quality), width=width
+                )
+                return [Encoded(mime, data, probe_time, quality)]
+        results = []
+        # The variants are encoded from a losslessly decoded copy of the input.
+        with NamedTemporaryFile(suffix=".png") as decoded:
+            self._decode([source + "[0]"], decoded.name, mime)
+            for width, quality in variants:
+                with NamedTemporaryFile(suffix=".png") as resized:
+                    variant = decoded.name
+                    if width is not None:
+                        variant = resized.name
+                        self._decode(
+                            [decoded.name, "-resize", "{}x>".format(width)],
+                            variant,
+                            mime,
+                        )
+                    target = quality_target(quality)
+                    quality, options = split_options(quality)
+                    if target is None:
+                        data = self._convert(variant, mime, quality, options)
+                    else:
+                        reference = None
+                        if target.metric == "ssim":
+                            reference = Image.open(variant).convert("L")
+                        quality, data = search_quality(
+                            lambda quality: self._convert(
+                                variant, mime, quality, options
+                            ),
+                            target,
+                            reference,
+                        )
+                    quality = join_options(quality, options)
+                results.append(Encoded(mime, data, probe_time, quality))
+        return results
+
+    def _probe(self, source):
+        # Ping mode reads only the headers of every frame or page.
+        output, error = _run(
+            ["magick", "identify", "-ping"]
+            + _magick_limits()
+            + ["-format", "%[magick] %w %h\\n", source]
+        )
+        frames = [line.split() for line in output.splitlines() if line.strip()]
+        if error or not frames:
+            raise EncoderError("Could not identify the image")
+        mime = frames[0][0]
+        pixels = max(int(width) * int(height) for _mime, width, height in frames)
+        check_budget(mime, pixels, len(frames))
+        return mime
+
+    def _decode(self, args, output, mime):
+        if _run(["magick"] + _magick_limits() + args + ["png:" + output])[1]:
+            raise EncoderError("Could not decode {}".format(mime))
+
+    def _convert(self, source, mime, quality=None, options=None, width=None):
+        options = options or {}
+        with NamedTemporaryFile(suffix=".avif") as tempf:
+            args = ["magick"] + _magick_limits()
+            if self.threads:
+                # This limits ImageMagick's own threads. It has no define for
+                # the threads of the AV1 encoder, which keeps its default.
+                args += ["-limit", "thread", str(self.threads)]
+            # The HEIC coder passes these defines on to libheif's encoder. It
+            # has none for tiles, so those are only set by Pillow.
+            if "speed" in options:
+                args += ["-define", "heic:speed=" + options["speed"]]
+            if "subsampling" in options:
+                chroma = options["subsampling"].replace(":", "")
+                args += ["-define", "heic:chroma=" + chroma]
+            args += [source]
+            if width is not None:
+                args += ["-resize", "{}x>".format(width)]
+            if quality is not None:
+                args += ["-quality", quality]
+            if "depth" in options:
+                args += ["-depth", options["depth"]]
+            _result, error = _run(args + ["avif:" + tempf.name])
+            if error:
+                raise EncoderError("Could not convert {} to AVIF".format(mime))
+            return tempf.read()
+
+
+# Grayscale modes of more than 8 bits, 16-bit integers, 32-bit integers and floats.
+HIGH_DEPTH_MODES = ("I", "I;16", "I;16B", "I;16L", "I;16N", "F")
+
+
+class PillowEncoder:
+    """Encodes images in-process with Pillow and libavif.
+
+    The input is decoded once and the output is kept in memory. Formats
+    Pillow can't read, like PDF and HEIC, are passed to the fallback encoder.
+    """
+
+    name = "pillow"
+
+    def __init__(self, fallback, threads=None):
+        self.fallback = fallback
+        self.threads = threads
+
+    def encode(self, source, quality=None):
+        """Returns the source format, the AVIF bytes, the probe time and the quality.
+
+        The source is a filename or a binary file object.
+        """
+        return self.encode_variants(source, [(None, quality)])[0]
+
+    def encode_variants(self, source, variants):
+        """Encodes a list of (width, quality) variants of the source.
+
+        A width of None keeps the original size. All the variants are
+        resized from the same decoded image.
+        """
+        results = self.encode_in_process(source, variants)
+        if results is not None:
+            return results
+        if not isinstance(source, str):
+            source.seek(0)
+        return self.fallback.encode_variants(source, variants)
+
+    def encode_in_process(self, source, variants):
+        """Encodes the variants like ``encode_variants``, or returns None if
+        the source is for the fallback encoder."""
+        try:
+            start = perf_counter()
+            # A running save can't be interrupted, so the time limit is
+            # checked before every encode, also between the search probes.
+            deadline = start + ENCODE_TIME_LIMIT
+            with Image.open(source) as image:
+                mime = image.format
+                # Opening an image reads only its header.
+                check_budget(
+                    mime, image.width * image.height, getattr(image, "n_frames", 1)
+                )
+                probe_time = perf_counter() - start
+                logging.info("Converting %s to AVIF", mime)
+                if any(
+                    split_options(quality)[1].get("depth", "8") != "8"
+                    for _width, quality in variants
+                ):
+                    raise EncoderError("Pillow encodes only 8 bits per channel")
+                if image.mode in HIGH_DEPTH_MODES:
+                    # Pillow would clip the values instead of scaling them.
+                    raise EncoderError(
+                        "Pillow can't encode {} images".format(image.mode)
+                    )
+                frame = image.copy()
+                base_options = {"exif": image.info.get("exif", b"")}
+                if self.threads:
+                    base_options["max_threads"] = self.threads
+                results = []
+                for width, quality in variants:
+                    variant = _resize(frame, width)
+                    target = quality_target(quality)
+                    quality, encoder_options = split_options(quality)
+                    options = dict(base_options, **_pillow_options(encoder_options))
+
+                    def encode(quality):
+                        if perf_counter() > deadline:
+                            raise ImageTooLarge(
+                                "{} took longer than {} s to encode".format(
+                                    mime, ENCODE_TIME_LIMIT
+                                )
+                            )
+                        output = BytesIO()
+                        variant.save(
+                            output, "AVIF", quality=_pillow_quality(quality), **options
+                        )
+                        return output.getvalue()
+
+                    if target is None:
+                        data = encode(quality)
+                    else:
+                        reference = None
+                        if target.metric == "ssim":
+                            reference = variant.convert("L")
+                        quality, data = search_quality(encode, target, reference)
+                    quality = join_options(quality, encoder_options)
+                    results.append(Encoded(mime, data, probe_time, quality))
+                return results
+        except ImageTooLarge:
+            raise
+        except Image.DecompressionBombError as error:
+            raise ImageTooLarge(str(error))
+        except Exception as error:
+            logging.info("Falling back to %s: %s", self.fallback.name, error)
+        return None
+
+
+def check_budget(mime, pixels, frames):
+    """Raises ImageTooLarge if a probed image has too many pixels in a frame,
+    or too many frames, or pages for a PDF."""
+    if pixels > MAX_MEGAPIXELS * 10**6:
+        raise ImageTooLarge(
+            "{} has {:.1f} megapixels, more than {}".format(
+                mime, pixels / 10**6, MAX_MEGAPIXELS
+            )
+        )
+    limit, unit = (MAX_PAGES, "pages") if mime == "PDF" else (MAX_FRAMES, "frames")
+    if frames > limit:
+        raise ImageTooLarge(
+            "{} has {} {}, more than {}".format(mime, frames, unit, limit)
+        )
+
+
+def quality_target(quality):
+    """Parses a "max_bytes=" or "ssim=" target from a quality, or returns None."""
+    quality = split_options(quality)[0]
+    if quality is None or "=" not in quality:
+        return None
+    metric, value = quality.split("=", 1)
+    return QualityTarget(metric, int(value) if metric == "max_bytes" else float(value))
+
+
+def split_options(quality):
+    """Splits a quality like "50;speed=9;tile_cols=1" into the quality and a
+    dictionary of the encoder options."""
+    if quality is None:
+        return None, {}
+    quality, *options = quality.split(";")
+    return quality or None, dict(option.split("=", 1) for option in options)
+
+
+def join_options(quality, options):
+    """The inverse of split_options."""
+    if not options:
+        return quality
+    return ";".join(
+        [quality or ""] + ["{}={}".format(name, options[name]) for name in options]
+    )
+
+
+def search_quality(encode, target, reference=None):
+    """Binary search of the quality that meets a size or similarity target.
+
+    ``encode`` encodes the decoded input at a quality. The largest quality
+    within ``max_bytes``, or the smallest one reaching the ``ssim`` of the
+    reference, is searched with at most SEARCH_MAX_PROBES probes, stopping
+    early when a probe is within SEARCH_TOLERANCE of the target. If no probe
+    meets the target, the lowest or the highest quality is used.
+
+    Returns the quality and the AVIF bytes.
+    """
+    metric, goal = target
+    low, high = 1, 100
+    probes = {}
+    best = None
+    while low <= high and len(probes) < SEARCH_MAX_PROBES:
+        quality = (low + high) // 2
+        data = probes[quality] = encode(str(quality))
+        if metric == "max_bytes":
+            score = len(data)
+            met = score <= goal
+            close = met and score >= goal * (1 - SEARCH_TOLERANCE)
+            higher = met
+        else:
+            score = ssim(reference, data)
+            met = score >= goal
+            close = met and score <= goal + (1 - goal) * SEARCH_TOLERANCE
+            higher = not met
+        logging.info("Quality %d probe: %s %s", quality, metric, score)
+        if met:
+            best = quality
+        if close:
+            break
+        if higher:
+            low = quality + 1
+        else:
+            high = quality - 1
+    if best is None:
+        best = 1 if metric == "max_bytes" else 100
+        if best not in probes:
+            probes[best] = encode(str(best))
+    logging.info("Quality search: %d probes, chose %d", len(probes), best)
+    return str(best), probes[best]
+
+
+def ssim(reference, data, block=8):
+    """Mean structural similarity of an AVIF image to a grayscale reference.
+
+    SSIM is computed on the luma in non-overlapping blocks.
+    """
+    with Image.open(BytesIO(data)) as image:
+        x = reference.convert("F")
+        y = image.convert("L").convert("F")
+    xx = ImageMath.lambda_eval(lambda args: args["x"] * args["x"], x=x)
+    yy = ImageMath.lambda_eval(lambda args: args["y"] * args["y"], y=y)
+    xy = ImageMath.lambda_eval(lambda args: args["x"] * args["y"], x=x, y=y)
+    mx, my, mxx, myy, mxy = [channel.reduce(block) for channel in (x, y, xx, yy, xy)]
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+
+    def similarity(args):
+        mx, my = args["mx"], args["my"]
+        covariance = args["mxy"] - mx * my
+        variance = args["mxx"] - mx * mx + args["myy"] - my * my
+        return ((mx * my * 2 + c1) * (covariance * 2 + c2)) / (
+            (mx * mx + my * my + c1) * (variance + c2)
+        )
+
+    result = ImageMath.lambda_eval(similarity, mx=mx, my=my, mxx=mxx, myy=myy, mxy=mxy)
+    return result.resize((1, 1), Image.BOX).getpixel((0, 0))
+
+
+def available_cpus():
+    """Number of CPUs available to this process, honoring cgroup quotas."""
+    cpus = len(os.sched_getaffinity(0))
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as file:
+            quota, period = file.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def encode_concurrency():
+    """Concurrent encodes on the host and threads per encode."""
+    cpus = available_cpus()
+    concurrency = ENCODE_CONCURRENCY or cpus
+    threads = ENCODE_THREADS or max(1, cpus // concurrency)
+    return concurrency, threads
+
+
+def create_encoder():
+    """The configured encoder engine with ImageMagick as the fallback."""
+    _concurrency, threads = encode_concurrency()
+    magick = MagickEncoder(threads=threads)
+    if ENCODER == "magick":
+        return magick
+    if ENCODER != "pillow":
+        raise ValueError("Unknown encoder: {}".format(ENCODER))
+    return PillowEncoder(fallback=magick, threads=threads)
+
+
+def create_offload():
+    """A thread pool for the encodes of requests under gevent workers.
+
+    With gevent, network waits don't block the worker, so a few processes
+    serve many fetches and cache reads at a time. A Pillow encode would
+    block all of them, so it runs in a real thread instead. Returns None for
+    the other workers, which encode in the request's own thread.
+    """
+    if "gevent" not in sys.modules:
+        # The gevent worker has imported it before the app.
+        return None
+    from gevent import monkey
+
+    if not monkey.is_module_patched("socket"):
+        return None
+    from gevent.threadpool import ThreadPoolExecutor
+
+    concurrency, _threads = encode_concurrency()
+    return ThreadPoolExecutor(max_workers=concurrency)
+
+
+def build_assets(directory, names):
+    """The static files by name, with their SRI hashes, fingerprinted names
+    and content by encoding.
+
+    The files are hashed and compressed once at startup.
+    """
+    import brotli
+
+    assets = {}
+    for name in names:
+        with open(os.path.join(directory, name), "rb") as file:
+            data = file.read()
+        digest = sha384(data).digest()
+        stem, extension = os.path.splitext(name)
+        variants = {"identity": data}
+        for encoding, compressed in (
+            ("br", brotli.compress(data)),
+            ("gzip", gzip.compress(data, mtime=0)),
+        ):
+            if len(compressed) < len(data):
+                variants[encoding] = compressed
+        assets[name] = Asset(
+            "{}.{}{}".format(stem, digest.hex()[:16], extension),
+            "sha384-{}".format(b64encode(digest).decode()),
+            mimetypes.guess_type(name)[0],
+            variants,
+        )
+    return assets
+
+
+def warm_up():
+    """Runs a tiny encode with every engine and a cache lookup, so the first
+    request doesn't pay for loading the codecs and connecting to the cache."""
+    start = perf_counter()
+    engine = encoder
+    while engine is not None:
+        image = BytesIO()
+        Image.new("RGB", (16, 16)).save(image, "PNG")
+        image.seek(0)
+        try:
+            engine.encode(image)
+        except Exception as error:
+            logging.warning("Could not warm up %s: %s", engine.name, error)
+        engine = getattr(engine, "fallback", None)
+    try:
+        cache.has("warm-up")
+    except Exception as error:
+        logging.warning("Could not warm up the cache: %s", error)
+    logging.info("Warm-up time: %.4f", perf_counter() - start)
+
+
+class HashingFile:
+    """A named temporary file that hashes what is written to it.
+
+    Uploads are received into it, so they're hashed in the same pass and
+    not read again just for the cache key.
+    """
+
+    def __init__(self):
+        self.file = NamedTemporaryFile()
+        self.name = self.file.name
+        self.hash = sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+
+class UploadRequest(Request):
+    """Receives uploaded files into hashing temporary files."""
+
+    def _get_file_stream(
+        self, total_content_length, content_type, filename=None, content_length=None
+    ):
+        return HashingFile()
+
 
 csp = {"default-src": ["'self'", "cdnjs.cloudflare.com"]}
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config["SEND_FILE_MAX_AGE_DEFAULT"] = MAX_AGE
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=X_FOR, x_proto=X_PROTO)
 talisman = Talisman(app, content_security_policy=csp, force_https=FORCE_HTTPS)
-cache = (
-    GoogleCloudStorageCache(bucket=GCP_BUCKET, default_timeout=MAX_AGE)
-    if GCP_BUCKET
-    else NullCache()
+cache = create_cache()
+assets = build_assets(os.path.join(app.root_path, "static"), STATIC_ASSETS)
+single_flight = SingleFlight(LOCK_DIR, SINGLE_FLIGHT_TIMEOUT)
+encoder = create_encoder()
+offload = create_offload()
+scheduler = EncodeScheduler(
+    LOCK_DIR, encode_concurrency()[0], ENCODE_QUEUE_SIZE, ENCODE_QUEUE_TIMEOUT
+)
+jobs = JobQueue(JOB_WORKERS, JOB_QUEUE_SIZE, JOB_TIMEOUT)
+origin = OriginClient(
+    os.path.join(LOCK_DIR, "hosts"),
+    REMOTE_POOL_SIZE,
+    REMOTE_HOST_CONCURRENCY,
+    (REMOTE_CONNECT_TIMEOUT, REMOTE_READ_TIMEOUT),
 )
 
 
+@app.before_request
+def start_timer():
+    """Starts timing the request for the latency histogram."""
+    g.request_start = perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    """Records the request latency and error responses."""
+    start = g.pop("request_start", None)
+    if start is not None:
+        request_seconds.labels(
+            request.endpoint or "",
+            g.get("metric_format", ""),
+            g.get("metric_quality", ""),
+        ).observe(perf_counter() - start)
+    if response.status_code >= 400:
+        errors.labels(response.status_code).inc()
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus metrics of all worker processes."""
+    registry = CollectorRegistry()
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry.register(REGISTRY)
+    registry.register(SchedulerCollector())
+    registry.register(OriginCollector())
+    return generate_latest(registry), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+
+
 @app.route("/favicon.ico")
 def favicon():
     """Sends legacy favicon."""
@@ -101,68 +1923,165 @@ def index():
     """Shows the main page."""
     if len(request.args) > 0:
         abort(404)
-    css_sri = calculate_sri_on_file(os.path.join(app.root_path, "static", "style.css"))
-    js_sri = calculate_sri_on_file(
-        os.path.join(app.root_path, "static", "javascript.js")
-    )
-    return render_template("index.html", title=TITLE, css_sri=css_sri, js_sri=js_sri)
+    return render_template("index.html", title=TITLE, assets=assets)
+
+
+@app.route("/assets/<name>")
+def asset_get(name):
+    """Sends a static file by its fingerprinted name.
+
+    The content never changes for the name, so it can be cached forever.
+    It's sent precompressed if the client accepts the encoding.
+    """
+    if len(request.args) > 0:
+        abort(404)
+    asset = next((asset for asset in assets.values() if asset.name == name), None)
+    if asset is None:
+        abort(404)
+    encoding = "identity"
+    for candidate in ("br", "gzip"):
+        if candidate in asset.variants and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    response = app.response_class(asset.variants[encoding], mimetype=asset.mimetype)
+    if encoding != "identity":
+        response.content_encoding = encoding
+    response.vary.add("Accept-Encoding")
+    response.set_etag("{}-{}".format(asset.sri, encoding))
+    response.cache_control.public = True
+    response.cache_control.max_age = ASSET_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
 
 
 @app.route("/api", methods=["GET"])
 def api_get():
     """An API endpoint for GET requests."""
-    url_hash = None
-
     url = request.args.get("url")
-    quality = request.args.get("quality")
-    if (
-        not isinstance(url, str)
-        or len(request.args) != 1
-        and quality is None
-        or len(request.args) != 2
-        and quality is not None
-    ):
-        abort(400)
-    if not url.startswith("https://") and not url.startswith("http://"):
+    if not isinstance(url, str) or not set(request.args) <= {
+        "url",
+        *QUALITY_PARAMS,
+        *OPTION_PARAMS,
+        *WIDTH_PARAMS,
+    }:
         abort(400)
-    # Recursive query
-    if (
-        url.startswith(url_for("api_get", _external=True))
-        or URL
-        and url.startswith(urljoin(URL, url_for("api_get")))
-    ):
-        abort(400)
-    # Request-URI Too Long
-    if len(url) > 2000:
-        abort(414)
-    quality = validate_quality(quality)
-    url_hash = sha256(url.encode("utf-8"))
-    if quality is not None:
-        logging.info("URL with encoding quality: %s", quality)
-        url_hash.update(quality.encode())
-    url_hash = url_hash.hexdigest()
-    value = cache.get(url_hash)
-    if value is not None:
-        data_hash = value.decode("utf-8")
-        if cache.has(data_hash):
-            return redirect(url_for("avif_get", image=data_hash))
-    content = get_content_from_url(url)
-    with NamedTemporaryFile() as tempf:
-        tempf.write(content)
-        return avif_convert(tempf.name, url_hash, quality)
+    validate_url(url)
+    quality = get_quality(request.args)
+    widths = get_widths(request.args)
+    url_hashes = [get_url_hash(url, quality, width) for width in widths]
+    data_hashes = [get_cached_url(url_hash) for url_hash in url_hashes]
+    if None not in data_hashes:
+        results = [(data_hash, None) for data_hash in data_hashes]
+    else:
+        results = single_flight.do(
+            _flight_key(url_hashes),
+            lambda waited: convert_url_widths(url, url_hashes, widths, quality, waited),
+            _shared_cache(),
+        )
+    return send_widths(widths, results, "widths" in request.args)
 
 
 @app.route("/api", methods=["POST"])
 def api_post():
-    """An API endpoint for POST requests."""
-    # check if the post request has the file part
-    if "file" not in request.files:
+    """An API endpoint for POST requests.
+
+    The image is a multipart "file" upload, or the raw body of the request.
+    """
+    # The limit applies before anything of the body is read.
+    request.max_content_length = POST_MAX_SIZE
+    if _is_image_body():
+        upload = receive_body()
+    elif "file" in request.files:
+        upload = request.files["file"].stream
+    else:
         abort(400)
-    quality = validate_quality(request.values.get("quality"))
-    file = request.files["file"]
-    with NamedTemporaryFile() as tempf:
-        file.save(tempf.name)
-        return avif_convert(tempf.name, quality=quality)
+    quality = get_quality(request.values)
+    widths = get_widths(request.values)
+    with upload:
+        upload.flush()
+        results = convert_widths(
+            upload.name, widths, quality=quality, data_hash=upload.hash
+        )
+    return send_widths(widths, results, "widths" in request.values)
+
+
+@app.route("/api/batch", methods=["POST"])
+def batch_post():
+    """Converts several uploaded files or URLs in parallel.
+
+    Answers with a JSON manifest of cached image locations, or with a ZIP
+    archive of the images if ``format=zip``.
+    """
+    output = request.args.get("format", "json")
+    if output not in ("json", "zip"):
+        abort(400)
+    if output == "json" and _shared_cache() is None:
+        abort(501)
+    # The limits apply before anything of the body is read. A form has a
+    # file and a quality per item, and the options of the batch.
+    request.max_content_length = BATCH_MAX_SIZE
+    request.max_form_parts = 2 * BATCH_MAX_ITEMS + len(QUALITY_PARAMS + OPTION_PARAMS)
+    with ExitStack() as stack:
+        items = get_batch_items(stack)
+        with ThreadPoolExecutor(max_workers=jobs.workers * 2) as threads:
+            futures = [
+                threads.submit(_convert_batch_item, jobs.process_pool(), item)
+                for item in items
+            ]
+            results = [future.result() for future in futures]
+    manifest = []
+    for item, (data_hash, image_bytes, error) in zip(items, results):
+        if output == "json" and error is None and image_bytes is not None:
+            # The image could not be stored in the cache.
+            error = 500
+        entry = {"name": item["name"], "status": "done" if error is None else "failed"}
+        if error is not None:
+            entry["error"] = error
+        elif output == "json":
+            entry["image"] = url_for("avif_get", image=data_hash)
+        else:
+            entry["file"] = data_hash
+            item["image_bytes"] = image_bytes
+        manifest.append(entry)
+    if output == "json":
+        return jsonify({"items": manifest})
+    return send_batch_zip(items, manifest)
+
+
+@app.route("/api/jobs", methods=["POST"])
+def job_post():
+    """Queues a conversion of an uploaded file or a URL."""
+    if _shared_cache() is None:
+        abort(501)
+    request.max_content_length = POST_MAX_SIZE
+    quality = get_quality(request.values)
+    url = request.values.get("url")
+    if "file" in request.files:
+        tempf = NamedTemporaryFile(delete=False)
+        with tempf:
+            request.files["file"].save(tempf)
+        job = jobs.submit(convert_job, tempf.name, None, quality)
+        if job is None:
+            os.unlink(tempf.name)
+    elif isinstance(url, str):
+        validate_url(url)
+        job = jobs.submit(convert_job, None, url, quality)
+    else:
+        abort(400)
+    if job is None:
+        abort(503, retry_after=10)
+    return send_job(job, 202)
+
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def job_get(job_id):
+    """Polls the status of a conversion job."""
+    if len(request.args) > 0 or not re.fullmatch(r"[0-9a-f]{32}", job_id):
+        abort(404)
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return send_job(job)
 
 
 @app.route("/<image>", methods=["GET"])
@@ -175,53 +2094,463 @@ def avif_get(image):
     if not match:
         abort(404)
     data_hash = match.group(0)
-    image_bytes = cache.get(data_hash)
-    if image_bytes is None:
-        abort(404)
-    return send_avif(image_bytes)
+    return send_cached(data_hash)
+
+
+def convert_job(executor, tempf_in, url, quality=None):
+    """Convert an uploaded file or a URL for a background job.
+
+    Returns the cache key of the image.
+    """
+    try:
+        data_hash, image_bytes = convert_source(executor, tempf_in, url, quality)
+    finally:
+        if tempf_in is not None:
+            os.unlink(tempf_in)
+    if image_bytes is not None:
+        raise RuntimeError("Could not store {} in the cache".format(data_hash))
+    return data_hash
+
+
+def convert_source(executor, tempf_in, url, quality=None):
+    """Convert a file or a URL, encoding in the executor.
+
+    Returns a tuple of the data hash and the image bytes, which are None
+    if the image can be fetched from the cache.
+    """
+    image_bytes = None
+    if url is not None:
+        url_hash = get_url_hash(url, quality)
+        data_hash = get_cached_url(url_hash)
+        if data_hash is None:
+            data_hash, image_bytes = single_flight.do(
+                url_hash,
+                lambda waited: convert_url(url, url_hash, quality, waited, executor),
+                _shared_cache(),
+            )
+    else:
+        data_hash, image_bytes = convert_file(
+            tempf_in, quality=quality, executor=executor
+        )
+    return data_hash, image_bytes
 
 
-def avif_convert(tempf_in, url_hash=None, quality=None):
-    """Convert an image to AVIF. If a cache is available, forwards to 'avif_get' function."""
-    logging.info("Input file size: %d", os.path.getsize(tempf_in))
-    data_hash = hash_sum(tempf_in, sha256())
+def convert_url(url, url_hash, quality=None, waited=False, executor=None):
+    """Download and convert an image unless another request already did it."""
+    results = convert_url_widths(url, [url_hash], [None], quality, waited, executor)
+    return results[0]
+
+
+def convert_url_widths(
+    url, url_hashes, widths, quality=None, waited=False, executor=None
+):
+    """Download and convert an image in several widths unless another request
+    already did it.
+
+    If the images of an expired URL are still cached, the origin is asked
+    whether the URL has changed. Failures are cached for a short while.
+    """
+    if waited:
+        data_hashes = [get_cached_url(url_hash) for url_hash in url_hashes]
+        if None not in data_hashes:
+            return [(data_hash, None) for data_hash in data_hashes]
+    records = [get_url_record(url_hash) for url_hash in url_hashes]
+    try:
+        download = get_content_from_url(url, _revalidation_headers(records))
+        if download is None:
+            origin_revalidations.labels("not_modified").inc()
+            for url_hash, record in zip(url_hashes, records):
+                _set_url_record(url_hash, record)
+            return [(record["data_hash"], None) for record in records]
+        tempf, data_hash, validators = download
+        with tempf:
+            return convert_widths(
+                tempf, widths, url_hashes, quality, data_hash, executor, validators
+            )
+    except HTTPException as error:
+        if 400 <= error.code < 500:
+            for url_hash in url_hashes:
+                _set_failed_url(url_hash, error.code)
+        raise
+    finally:
+        conversion.fetch_time = None
+
+
+def convert_file(tempf_in, url_hash=None, quality=None, data_hash=None, executor=None):
+    """Convert an image to AVIF and store it in the cache.
+
+    The input is a filename or a binary file object. If its SHA-256 hash
+    object is not given, it's computed from the file. The encoding is done
+    in the executor if one is given.
+
+    Returns a tuple of the data hash and the image bytes, which are None
+    if the image can be fetched from the cache.
+    """
+    return convert_widths(tempf_in, [None], [url_hash], quality, data_hash, executor)[0]
+
+
+def convert_widths(
+    tempf_in,
+    widths,
+    url_hashes=None,
+    quality=None,
+    data_hash=None,
+    executor=None,
+    validators=None,
+):
+    """Convert an image to AVIF in several widths, decoding it only once.
+
+    A width of None keeps the original size. Every width is stored under its
+    own key, derived from the data hash and the width. The URL hash of the
+    same index gets a record of the image and the validators of the origin's
+    response.
+
+    Returns a list of tuples of the data hash and the image bytes per width.
+    """
+    logging.info("Input file size: %d", _file_size(tempf_in))
+    if data_hash is None:
+        data_hash = hash_sum(tempf_in, sha256())
     if quality is not None:
         logging.info("Encoding quality: %s", quality)
         data_hash.update(quality.encode())
-    data_hash = data_hash.hexdigest() + ".avif"
-    if cache.has(data_hash):
-        if url_hash is not None:
-            cache.set(url_hash, data_hash.encode("utf-8"))
-        return redirect(url_for("avif_get", image=data_hash))
-    mime, _error = _run(["magick", "identify", "-format", "%[magick]", tempf_in])
-    logging.info("Converting %s to AVIF", mime)
-    with NamedTemporaryFile(suffix=".avif") as tempf:
-        tempf_out = tempf.name
+    keys = [_variant_hash(data_hash, width) for width in widths]
+    _set_metric_labels(quality=_quality_label(quality))
+    missing = []
+    for width, key in zip(widths, keys):
+        if cache.has(key):
+            cache_lookups.labels("data", "hit").inc()
+        else:
+            cache_lookups.labels("data", "miss").inc()
+            missing.append((width, key))
+    encoded = {}
+    if missing:
+        encoded = single_flight.do(
+            _flight_key([key for _width, key in missing]),
+            lambda waited: encode_file(tempf_in, missing, quality, waited, executor),
+            _shared_cache(),
+        )
+    else:
+        _observe_fetch_time("", _quality_label(quality))
+    results = []
+    for url_hash, key in zip(url_hashes or [None] * len(keys), keys):
+        image_bytes, metadata = encoded.get(key, (None, {}))
+        if image_bytes is None:
+            record = {"data_hash": key, **metadata, **(validators or {})}
+            _set_url_record(url_hash, record)
+        results.append((key, image_bytes))
+    return results
+
+
+def encode_file(tempf_in, variants, quality=None, waited=False, executor=None):
+    """Encode (width, data hash) variants of an image unless another request
+    already did it.
+
+    Returns a dictionary of tuples of the image bytes and the metadata of
+    the image by data hash. The bytes are None if the image was stored in
+    the cache. Images another request encoded are left out.
+    """
+    if waited:
+        variants = [(width, key) for width, key in variants if not cache.has(key)]
+    if not variants:
+        return {}
+    qualities = []
+    for _width, key in variants:
+        encode_quality = quality
+        if quality_target(quality) is not None:
+            # The quality may have been searched for the same input and target.
+            chosen = cache.get("quality-" + key)
+            if chosen is not None:
+                encode_quality = chosen.decode("utf-8")
+        qualities.append(encode_quality)
+    requested = [(width, q) for (width, _key), q in zip(variants, qualities)]
+    with scheduler.slot(
+        background=executor is not None
+    ), encodes_in_progress.track_inprogress():
         start = perf_counter()
-        args = ["magick", tempf_in + "[0]"]
-        if quality is not None:
-            args += ["-quality", quality]
-        _result, error = _run(args + ["avif:" + tempf_out])
-        if error:
-            logging.error("Could not convert %s to AVIF", mime)
+        try:
+            if executor is None and offload is not None:
+                results = encode_offloaded(tempf_in, requested)
+            elif executor is None:
+                results = encoder.encode_variants(tempf_in, requested)
+            elif isinstance(tempf_in, str):
+                results = executor.submit(encode_source, tempf_in, requested).result()
+            else:
+                with NamedTemporaryFile() as tempf:
+                    shutil.copyfileobj(tempf_in, tempf)
+                    tempf.flush()
+                    results = executor.submit(
+                        encode_source, tempf.name, requested
+                    ).result()
+        except ImageTooLarge as error:
+            logging.warning(error)
+            abort(413)
+        except EncoderError as error:
+            logging.error(error)
+            abort(400)
+    encode_time = perf_counter() - start
+    logging.info("Encoding time: %.4f", encode_time)
+    _observe_encode(results, quality, encode_time, _file_size(tempf_in))
+    encoded = {}
+    for (_width, key), encode_quality, result in zip(variants, qualities, results):
+        logging.info("Output file size: %d", len(result.data))
+        if result.quality != encode_quality:
+            cache.set("quality-" + key, result.quality.encode("utf-8"))
+        created = time()
+        metadata = {
+            "size": len(result.data),
+            "source_mime": result.mime,
+            "quality": result.quality,
+            "created": created,
+            "expires": created + MAX_AGE,
+        }
+        # The acknowledgement of the write is trusted, NullCache acknowledges
+        # everything without storing it.
+        stored = _shared_cache() is not None and cache.set(key, result.data)
+        encoded[key] = (None if stored else result.data, metadata)
+    return encoded
+
+
+def encode_offloaded(source, variants):
+    """Encodes with Pillow in the offload threads, and with ImageMagick in
+    the request's greenlet.
+
+    gevent waits for subprocesses only in the thread of its event loop, and
+    the waits don't block the other greenlets.
+    """
+    magick = encoder
+    if isinstance(encoder, PillowEncoder):
+        results = offload.submit(encoder.encode_in_process, source, variants).result()
+        if results is not None:
+            return results
+        if not isinstance(source, str):
+            source.seek(0)
+        magick = encoder.fallback
+    return magick.encode_variants(source, variants)
+
+
+def encode_source(source, variants):
+    """Encode image variants with the configured engine, also in a worker process."""
+    return encoder.encode_variants(source, variants)
+
+
+def get_cached_url(url_hash):
+    """Returns the data hash of a converted URL, if it is fresh and in the cache.
+
+    The record of the URL is enough if it knows when the image expires and
+    the backend doesn't evict anything before that. Otherwise the image is
+    looked up too. Aborts with the error of a recently failed URL.
+    """
+    record = get_url_record(url_hash)
+    if record is not None and "error" in record:
+        # A local tier may keep the record longer than it was stored for.
+        if time() - record["checked"] < NEGATIVE_CACHE_TIMEOUT:
+            cache_lookups.labels("url", "negative").inc()
+            abort(record["error"])
+        record = None
+    if record is not None and time() - record.get("checked", time()) < URL_MAX_AGE:
+        if "expires" in record and _evicts_only_on_expiry():
+            found = time() < record["expires"]
+        else:
+            found = cache.has(record["data_hash"])
+        if found:
+            cache_lookups.labels("url", "hit").inc()
+            return record["data_hash"]
+    cache_lookups.labels("url", "miss").inc()
+    return None
+
+
+def get_url_record(url_hash):
+    """Returns the cached record of a URL, also if it has expired."""
+    value = cache.get(url_hash)
+    if value is None:
+        return None
+    if not value.startswith(b"{"):
+        # Older versions stored only the data hash.
+        return {"data_hash": value.decode("utf-8")}
+    return json.loads(value)
+
+
+def send_widths(widths, results, manifest=False):
+    """Sends the image of a single width, or a JSON manifest of the cached
+    image locations of all the widths."""
+    if not manifest:
+        return send_result(*results[0])
+    variants = []
+    for width, (data_hash, image_bytes) in zip(widths, results):
+        if image_bytes is not None:
+            # The image could not be stored in the cache.
+            abort(500)
+        variants.append(
+            {
+                "width": "original" if width is None else width,
+                "image": url_for("avif_get", image=data_hash),
+            }
+        )
+    return jsonify({"variants": variants})
+
+
+def send_result(data_hash, image_bytes):
+    """Forwards to 'avif_get' function, or sends the image if it's not cached.
+
+    With SERVE_CACHED the cached image is sent directly instead.
+    """
+    if image_bytes is not None:
+        return send_avif(image_bytes, data_hash)
+    if SERVE_CACHED:
+        return send_cached(data_hash)
+    return redirect(url_for("avif_get", image=data_hash))
+
+
+def send_cached(data_hash):
+    """Sends an image from the cache.
+
+    The ETag is the content hash in the name, so a conditional request is
+    answered without fetching the image. The image is streamed in chunks
+    and range requests are supported.
+    """
+    etag = data_hash.removesuffix(".avif")
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        return _set_cache_headers(response, etag)
+    stream = cache_open(cache, data_hash)
+    if stream is None:
+        abort(404)
+    file, size = stream
+    response = app.response_class(
+        wrap_file(request.environ, file, STREAM_CHUNK_SIZE),
+        mimetype="image/avif",
+        direct_passthrough=True,
+    )
+    response.content_length = size
+    _set_cache_headers(response, etag)
+    try:
+        return response.make_conditional(
+            request, accept_ranges=True, complete_length=size
+        )
+    except RequestedRangeNotSatisfiable:
+        file.close()
+        raise
+
+
+def get_batch_items(stack):
+    """Parses the files or the JSON list of URLs of a batch request.
+
+    Every item has a name, a quality, and either a temporary file, which is
+    closed with the exit stack, or a URL.
+    """
+    items = []
+    if request.is_json:
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
             abort(400)
-        logging.info("Encoding time: %.4f", perf_counter() - start)
-        logging.info("Output file size: %d", os.path.getsize(tempf_out))
-        image_bytes = tempf.read()
-    if cache.set(data_hash, image_bytes) and cache.has(data_hash):
-        if url_hash is not None:
-            cache.set(url_hash, data_hash.encode("utf-8"))
-        return redirect(url_for("avif_get", image=data_hash))
-    return send_avif(image_bytes)
-
-
-def send_avif(image_bytes):
-    """Sends the file with an AVIF MIME type and sets an ETag."""
-    response = send_file(BytesIO(image_bytes), mimetype="image/avif", max_age=MAX_AGE)
-    response.set_etag(sha256(image_bytes).hexdigest())
+        urls = body.get("urls", [])
+        entries = body.get("items", [{"url": url} for url in urls])
+        if not isinstance(entries, list):
+            abort(400)
+        if len(entries) > BATCH_MAX_ITEMS:
+            abort(413)
+        for entry in entries:
+            if not isinstance(entry, dict) or not isinstance(entry.get("url"), str):
+                abort(400)
+            # An item's own quality or target replaces the one of the batch.
+            values = body
+            if any(name in entry for name in QUALITY_PARAMS):
+                values = entry
+            values = {
+                name: str(values[name])
+                for name in QUALITY_PARAMS
+                if values.get(name) is not None
+            }
+            # Encoder options of an item replace those of the batch one by one.
+            for name in OPTION_PARAMS:
+                value = entry.get(name, body.get(name))
+                if value is not None:
+                    values[name] = str(value)
+            items.append(
+                {
+                    "name": entry["url"],
+                    "url": entry["url"],
+                    "quality": get_quality(values),
+                }
+            )
+    else:
+        files = request.files.getlist("file")
+        if len(files) > BATCH_MAX_ITEMS:
+            abort(413)
+        qualities = request.values.getlist("quality")
+        if len(qualities) not in (0, 1, len(files)):
+            abort(400)
+        default_quality = get_quality(request.values)
+        for i, file in enumerate(files):
+            # The file was received into a temporary file already.
+            upload = stack.enter_context(file.stream)
+            quality = default_quality
+            if len(qualities) > 1:
+                quality = join_options(
+                    validate_quality(qualities[i]), get_options(request.values)
+                )
+            items.append(
+                {"name": file.filename, "file": upload.name, "quality": quality}
+            )
+    if not items:
+        abort(400)
+    for item in items:
+        if "url" in item:
+            validate_url(item["url"])
+    return items
+
+
+def send_batch_zip(items, manifest):
+    """Sends the images of a batch and its manifest as a ZIP archive."""
+    tempf = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    with zipfile.ZipFile(tempf, "w") as archive:
+        names = set()
+        for item, entry in zip(items, manifest):
+            if "file" not in entry or entry["file"] in names:
+                continue
+            image_bytes = item["image_bytes"] or cache.get(entry["file"])
+            if image_bytes is None:
+                entry["status"] = "failed"
+                entry["error"] = 404
+                del entry["file"]
+                continue
+            names.add(entry["file"])
+            archive.writestr(entry["file"], image_bytes)
+        archive.writestr(
+            "manifest.json",
+            json.dumps({"items": manifest}),
+            compress_type=zipfile.ZIP_DEFLATED,
+        )
+    tempf.seek(0)
+    return send_file(
+        tempf,
+        mimetype="application/zip",
+        as_attachment=True,
+        download_name="avif.zip",
+    )
+
+
+def send_job(job, status=200):
+    """Sends a job record as JSON."""
+    body = {key: job[key] for key in ("id", "status", "created", "error") if key in job}
+    if "image" in job:
+        body["image"] = url_for("avif_get", image=job["image"])
+    response = jsonify(body)
+    response.status_code = status
+    response.headers["Location"] = url_for("job_get", job_id=job["id"])
     return response
 
 
+def send_avif(image_bytes, data_hash):
+    """Sends the file with an AVIF MIME type and the data hash as the ETag."""
+    return send_file(
+        BytesIO(image_bytes),
+        mimetype="image/avif",
+        etag=data_hash.removesuffix(".avif"),
+        max_age=MAX_AGE,
+    )
+
+
 def calculate_sri_on_file(filename):
     """Calculate SRI string."""
     hash_digest = hash_sum(filename, sha384()).digest()
@@ -229,6 +2558,17 @@ def calculate_sri_on_file(filename):
     return "sha384-{}".format(hash_base64)
 
 
+def receive_body():
+    """Receives the raw body of a request into a hashing temporary file."""
+    upload = HashingFile()
+    try:
+        shutil.copyfileobj(request.stream, upload, STREAM_CHUNK_SIZE)
+    except BaseException:
+        upload.close()
+        raise
+    return upload
+
+
 def hash_sum(filename, hash_func):
     """Compute message digest from a file."""
     byte_array = bytearray(128 * 1024)
@@ -239,27 +2579,191 @@ def hash_sum(filename, hash_func):
     return hash_func
 
 
-def get_content_from_url(url):
-    """Download content from URL."""
+def get_content_from_url(url, headers=None):
+    """Download content from URL.
+
+    The response is streamed into a spooled temporary file and hashed on
+    the fly. Returns the file, positioned at the start, its SHA-256 hash
+    object and the validators of the response. With conditional request
+    headers, returns None if the content has not been modified.
+    """
+    tempf = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    data_hash = sha256()
+    start = perf_counter()
     try:
-        logging.info("Checking URL: %s", url)
-        response = requests.head(url, timeout=REMOTE_REQUEST_TIMEOUT)
-        content_type = response.headers.get("Content-Type")
-        if not isinstance(content_type, str) or (
-            not content_type.startswith("image/")
-            and content_type not in SUPPORTED_MIMES
-        ):
-            abort(400)
-        content_length = response.headers.get("Content-Length")
-        if isinstance(content_length, str) and int(content_length) > GET_MAX_SIZE:
-            abort(406)
         logging.info("Fetching URL: %s", url)
-        response = requests.get(url, timeout=REMOTE_REQUEST_TIMEOUT)
+        with origin.get(url, headers) as response:
+            if headers and response.status_code == requests.codes.not_modified:
+                tempf.close()
+                return None
+            validators = _validators(response.headers)
+            content_type = response.headers.get("Content-Type")
+            if not isinstance(content_type, str) or (
+                not content_type.startswith("image/")
+                and content_type not in SUPPORTED_MIMES
+            ):
+                abort(400)
+            if response.status_code != requests.codes.ok:  # pragma: no cover
+                abort(400)
+            content_length = response.headers.get("Content-Length")
+            if isinstance(content_length, str) and int(content_length) > GET_MAX_SIZE:
+                abort(406)
+            size = 0
+            for chunk in response.iter_content(chunk_size=128 * 1024):
+                size += len(chunk)
+                if size > GET_MAX_SIZE:
+                    abort(406)
+                tempf.write(chunk)
+                data_hash.update(chunk)
     except requests.exceptions.RequestException:
+        tempf.close()
+        abort(400)
+    except BaseException:
+        tempf.close()
+        raise
+    conversion.fetch_time = perf_counter() - start
+    tempf.seek(0)
+    return tempf, data_hash, validators
+
+
+def get_url_hash(url, quality=None, width=None):
+    """Cache key of a URL conversion."""
+    url_hash = sha256(url.encode("utf-8"))
+    if quality is not None:
+        logging.info("URL with encoding quality: %s", quality)
+        url_hash.update(quality.encode())
+    if width is not None:
+        url_hash.update("width={}".format(width).encode())
+    return url_hash.hexdigest()
+
+
+def validate_url(url):
+    if not url.startswith("https://") and not url.startswith("http://"):
         abort(400)
-    if response.status_code != requests.codes.ok:  # pragma: no cover
+    # Recursive query
+    if (
+        url.startswith(url_for("api_get", _external=True))
+        or URL
+        and url.startswith(urljoin(URL, url_for("api_get")))
+    ):
+        abort(400)
+    # Request-URI Too Long
+    if len(url) > 2000:
+        abort(414)
+
+
+def get_quality(values):
+    """Validates the quality, or a max_bytes or target_ssim target, of a request.
+
+    A target is returned as a quality like "max_bytes=20000" or "ssim=0.95",
+    and encoder options are appended like "50;speed=9", which makes them a
+    part of the cache keys.
+    """
+    names = [name for name in QUALITY_PARAMS if values.get(name) is not None]
+    if len(names) > 1:
         abort(400)
-    return response.content
+    if names == ["max_bytes"]:
+        quality = validate_max_bytes(values.get("max_bytes"))
+    elif names == ["target_ssim"]:
+        quality = validate_target_ssim(values.get("target_ssim"))
+    else:
+        quality = validate_quality(values.get("quality"))
+    return join_options(quality, get_options(values))
+
+
+def get_options(values):
+    """Validates the encoder options of a request.
+
+    An option is taken from the request, its preset, the option's default
+    or the default preset, in that order.
+    """
+    preset = values.get("preset")
+    if preset is not None and preset not in PRESETS:
+        abort(400)
+    defaults = {
+        "speed": DEFAULT_SPEED,
+        "tile_rows": DEFAULT_TILE_ROWS,
+        "tile_cols": DEFAULT_TILE_COLS,
+        "subsampling": DEFAULT_SUBSAMPLING,
+        "depth": DEFAULT_DEPTH,
+    }
+    layers = [
+        values,
+        PRESETS.get(preset, {}),
+        defaults,
+        PRESETS.get(DEFAULT_PRESET, {}),
+    ]
+    options = {}
+    for name in ENCODER_OPTIONS:
+        for layer in layers:
+            if layer.get(name) is not None:
+                options[name] = validate_option(name, layer[name])
+                break
+    return options
+
+
+def validate_option(name, value):
+    if name not in ("subsampling", "depth"):
+        try:
+            value = str(int(value))
+        except ValueError:
+            abort(400)
+    if value not in OPTION_CHOICES[name]:
+        abort(400)
+    return value
+
+
+def get_widths(values):
+    """Validates the width or the comma-separated widths of a request.
+
+    Returns a list of widths, where None is the original width.
+    """
+    width, widths = values.get("width"), values.get("widths")
+    if width is not None and widths is not None:
+        abort(400)
+    if width is not None:
+        return [validate_width(width)]
+    if widths is None:
+        return [None]
+    widths = [validate_width(width) for width in widths.split(",")]
+    if len(widths) > WIDTHS_MAX or len(set(widths)) != len(widths):
+        abort(400)
+    if _shared_cache() is None:
+        # The manifest of the widths refers to the cached images.
+        abort(501)
+    return widths
+
+
+def validate_width(width):
+    if width == "original":
+        return None
+    try:
+        width = int(width)
+    except ValueError:
+        abort(400)
+    if width < 1:
+        abort(400)
+    return width
+
+
+def validate_max_bytes(max_bytes):
+    try:
+        max_bytes = int(max_bytes)
+    except ValueError:
+        abort(400)
+    if max_bytes < 1:
+        abort(400)
+    return "max_bytes={}".format(max_bytes)
+
+
+def validate_target_ssim(target_ssim):
+    try:
+        target_ssim = float(target_ssim)
+    except ValueError:
+        abort(400)
+    if not 0 < target_ssim < 1:
+        abort(400)
+    return "ssim={:g}".format(target_ssim)
 
 
 def validate_quality(quality):
@@ -278,16 +2782,221 @@ def validate_quality(quality):
     return quality
 
 
+def _flight_key(keys):
+    if len(keys) == 1:
+        return keys[0]
+    return sha256("".join(keys).encode()).hexdigest()
+
+
+def _variant_hash(data_hash, width):
+    if width is not None:
+        data_hash = data_hash.copy()
+        data_hash.update("width={}".format(width).encode())
+    return data_hash.hexdigest() + ".avif"
+
+
+def _set_url_record(url_hash, record):
+    # The record is a single value, so readers never see half of it.
+    if url_hash is not None:
+        record = dict(record, checked=time())
+        cache.set(url_hash, json.dumps(record).encode("utf-8"))
+
+
+def _set_failed_url(url_hash, code):
+    record = {"error": code, "checked": time()}
+    cache.set(url_hash, json.dumps(record).encode("utf-8"), NEGATIVE_CACHE_TIMEOUT)
+
+
+def _validators(headers):
+    # Response headers, or a URL record, to the validators of a URL record.
+    validators = {}
+    for name, header in (("etag", "ETag"), ("last_modified", "Last-Modified")):
+        value = headers.get(name) or headers.get(header)
+        if value:
+            validators[name] = value
+    return validators
+
+
+def _revalidation_headers(records):
+    # Conditional request headers, if the cached images of the URL records
+    # can be reused when the origin hasn't changed.
+    if not records or any(
+        record is None or "data_hash" not in record for record in records
+    ):
+        return None
+    validators = _validators(records[0])
+    if not validators or any(_validators(record) != validators for record in records):
+        return None
+    if not all(cache.has(record["data_hash"]) for record in records):
+        return None
+    headers = {}
+    if "etag" in validators:
+        headers["If-None-Match"] = validators["etag"]
+    if "last_modified" in validators:
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def _set_cache_headers(response, etag):
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = MAX_AGE
+    response.expires = int(time() + MAX_AGE)
+    return response
+
+
+def _authoritative_cache():
+    return cache.tiers[-1][1] if isinstance(cache, TieredCache) else cache
+
+
+def _evicts_only_on_expiry():
+    # Object stores keep everything until it expires, while memory, disk
+    # and Redis caches may evict images to make room.
+    return isinstance(_authoritative_cache(), (CloudStorageCache, S3Cache))
+
+
+def _is_image_body():
+    mimetype = request.mimetype
+    return mimetype.startswith("image/") or mimetype in SUPPORTED_MIMES
+
+
+def _shared_cache():
+    return None if isinstance(cache, NullCache) else cache
+
+
+def _observe_encode(results, quality, encode_time, input_size):
+    mime = results[0].mime
+    quality = _quality_label(quality)
+    _set_metric_labels(mime, quality)
+    _observe_fetch_time(mime, quality)
+    probe_seconds.labels(mime, quality).observe(results[0].probe_time)
+    encode_seconds.labels(mime, quality).observe(encode_time - results[0].probe_time)
+    input_bytes.labels(mime).inc(input_size)
+    for result in results:
+        output_bytes.labels(mime).inc(len(result.data))
+        if result.data:
+            compression_ratio.labels(mime).observe(input_size / len(result.data))
+
+
+def _observe_fetch_time(mime, quality):
+    fetch_time = getattr(conversion, "fetch_time", None)
+    if fetch_time is not None:
+        conversion.fetch_time = None
+        fetch_seconds.labels(mime, quality or "").observe(fetch_time)
+
+
+def _quality_label(quality):
+    # Targets are labelled by their metric to keep the label values bounded.
+    target = quality_target(quality)
+    return target.metric if target is not None else split_options(quality)[0] or ""
+
+
+def _set_metric_labels(mime=None, quality=None):
+    if has_request_context():
+        if mime is not None:
+            g.metric_format = mime
+        if quality is not None:
+            g.metric_quality = quality
+
+
+def _sizeof(value):
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+def _convert_batch_item(executor, item):
+    try:
+        data_hash, image_bytes = convert_source(
+            executor, item.get("file"), item.get("url"), item["quality"]
+        )
+    except HTTPException as error:
+        errors.labels(error.code).inc()
+        return None, None, error.code
+    except Exception:
+        logging.exception("Could not convert %s", item["name"])
+        errors.labels(500).inc()
+        return None, None, 500
+    return data_hash, image_bytes, None
+
+
+def _file_size(source):
+    if isinstance(source, str):
+        return os.path.getsize(source)
+    size = source.seek(0, os.SEEK_END)
+    source.seek(0)
+    return size
+
+
+def _resize(image, width):
+    # Images are only scaled down, keeping the aspect ratio.
+    if width is None or width >= image.width:
+        return image
+    if image.mode in ("1", "P"):
+        image = image.convert("RGBA")
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def _pillow_options(options):
+    # Tiles are given as log2 of the rows and columns, like to libavif.
+    pillow_options = {}
+    for name in ("speed", "tile_rows", "tile_cols"):
+        if name in options:
+            pillow_options[name] = int(options[name])
+    if "subsampling" in options:
+        pillow_options["subsampling"] = options["subsampling"]
+    return pillow_options
+
+
+def _pillow_quality(quality):
+    # ImageMagick treats a missing or zero quality as its default, 50.
+    if quality is None or int(quality) == 0:
+        return 50
+    return int(quality)
+
+
+def _magick_limits():
+    # Resource limits of a single ImageMagick command.
+    return [
+        "-limit",
+        "area",
+        "{}MP".format(MAX_MEGAPIXELS),
+        "-limit",
+        "memory",
+        ENCODE_MEMORY_LIMIT,
+        "-limit",
+        "map",
+        ENCODE_MEMORY_LIMIT,
+        "-limit",
+        "disk",
+        ENCODE_DISK_LIMIT,
+        "-limit",
+        "time",
+        str(ENCODE_TIME_LIMIT),
+    ]
+
+
 def _run(args):
     output = ""
     error = False
     try:
-        result = run(args, capture_output=True, check=True, text=True)
+        # Delegates like Ghostscript aren't bound by ImageMagick's time limit.
+        result = run(
+            args,
+            capture_output=True,
+            check=True,
+            text=True,
+            timeout=ENCODE_TIME_LIMIT + 10,
+        )
         output = result.stdout
-    except CalledProcessError:
+    except (CalledProcessError, TimeoutExpired):
         error = True
     return output, error
 
 
+if WARM_UP:
+    warm_up()
+
 if __name__ == "__main__":  # pragma: no cover
     app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
@@ -0,0 +1,202 @@
+"""Converts images into the cache before they are requested.
+
+    python prewarm.py images/ --journal prewarm.jsonl
+    python prewarm.py urls.txt --quality 70 --processes 8
+
+A source is a directory, whose images are converted like uploads, or a
+file of URLs, one per line, converted like ``/api?url=``. The cache keys
+are the same as the API's, so the images are served from the cache
+afterwards. Images already in the cache are skipped. Finished items are
+appended to the journal, and a run with the same journal continues where
+the previous one stopped.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from hashlib import sha256
+from time import perf_counter
+
+from flask_caching.backends import NullCache
+from werkzeug.exceptions import HTTPException
+
+IMAGE_EXTENSIONS = (
+    ".avif",
+    ".bmp",
+    ".gif",
+    ".heic",
+    ".heif",
+    ".jpeg",
+    ".jpg",
+    ".pdf",
+    ".png",
+    ".tif",
+    ".tiff",
+    ".webp",
+)
+
+
+def sources(paths):
+    """Yields the image files of directories and the URLs of URL lists."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(root, name)
+        else:
+            with open(path) as file:
+                for line in file:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        yield line
+
+
+def is_url(source):
+    return source.startswith(("http://", "https://"))
+
+
+def read_journal(filename, quality):
+    """Sources that were already converted or found in the cache."""
+    done = set()
+    if filename is None or not os.path.exists(filename):
+        return done
+    with open(filename) as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A line cut short by an interrupted run.
+                continue
+            if entry.get("quality") == quality and entry["status"] != "failed":
+                done.add(entry["source"])
+    return done
+
+
+def warm(executor, source, quality):
+    """Converts a file or a URL into the cache unless it's there already.
+
+    Returns a tuple of the status, "cached" or "converted", the cache key
+    of the image and the size of a converted file.
+    """
+    import main
+
+    # The same validation as for a request to the configured URL.
+    with main.app.test_request_context(base_url=main.URL or None):
+        return _warm(main, executor, source, quality)
+
+
+def _warm(main, executor, source, quality):
+    if is_url(source):
+        main.validate_url(source)
+        data_hash = main.get_cached_url(main.get_url_hash(source, quality))
+        if data_hash is not None:
+            return "cached", data_hash, 0
+        data_hash, image_bytes = main.convert_source(executor, None, source, quality)
+        size = 0
+    else:
+        file_hash = main.hash_sum(source, sha256())
+        key = file_hash.copy()
+        if quality is not None:
+            key.update(quality.encode())
+        if main.cache.has(key.hexdigest() + ".avif"):
+            return "cached", key.hexdigest() + ".avif", 0
+        data_hash, image_bytes = main.convert_file(
+            source, quality=quality, data_hash=file_hash, executor=executor
+        )
+        size = os.path.getsize(source)
+    if image_bytes is not None:
+        raise RuntimeError("Could not store {} in the cache".format(data_hash))
+    return "converted", data_hash, size
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "sources", nargs="+", help="directories of images or files of URLs"
+    )
+    parser.add_argument("--journal", help="progress file for resuming a run")
+    parser.add_argument("--processes", type=int, help="encoding processes")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--quality")
+    target.add_argument("--max-bytes")
+    target.add_argument("--target-ssim")
+    parser.add_argument("--preset", help="encoder preset, like fast or archive")
+    return parser.parse_args(args)
+
+
+def run(args=None):
+    args = parse_args(args)
+    # The app configures itself from the environment when it's imported.
+    import main
+
+    logging.disable(logging.INFO)
+    if isinstance(main.cache, NullCache):
+        print("Set CACHE_URL or GCP_BUCKET to choose the cache", file=sys.stderr)
+        return 2
+    values = {
+        "quality": args.quality,
+        "max_bytes": args.max_bytes,
+        "target_ssim": args.target_ssim,
+        "preset": args.preset,
+    }
+    try:
+        quality = main.get_quality(values)
+    except HTTPException:
+        print("Invalid quality", file=sys.stderr)
+        return 2
+    done = read_journal(args.journal, quality)
+    pending = [source for source in sources(args.sources) if source not in done]
+    processes = args.processes or main.available_cpus()
+    counts = {"cached": 0, "converted": 0, "failed": 0}
+    input_bytes = 0
+    journal = open(args.journal, "a") if args.journal else None
+    start = perf_counter()
+    try:
+        with ProcessPoolExecutor(processes) as executor, ThreadPoolExecutor(
+            processes * 2
+        ) as threads:
+            futures = {
+                threads.submit(warm, executor, source, quality): source
+                for source in pending
+            }
+            for future in as_completed(futures):
+                entry = {"source": futures[future], "quality": quality}
+                try:
+                    entry["status"], entry["image"], size = future.result()
+                    input_bytes += size
+                except HTTPException as error:
+                    entry.update(status="failed", error=error.code)
+                except Exception as error:
+                    entry.update(status="failed", error=str(error))
+                counts[entry["status"]] += 1
+                if entry["status"] == "failed":
+                    print("{source}: {error}".format(**entry), file=sys.stderr)
+                if journal is not None:
+                    journal.write(json.dumps(entry) + "\n")
+                    journal.flush()
+    finally:
+        if journal is not None:
+            journal.close()
+    elapsed = perf_counter() - start
+    print(
+        "{} skipped from the journal, {cached} cached, {converted} converted, "
+        "{failed} failed in {:.1f} s ({:.2f} images/s, {:.2f} MB/s)".format(
+            len(done),
+            elapsed,
+            counts["converted"] / elapsed if elapsed else 0,
+            input_bytes / elapsed / 10**6 if elapsed else 0,
+            **counts,
+        ),
+        file=sys.stderr,
+    )
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -1,20 +1,69 @@
 import os
 import subprocess
+import sys
+import threading
+import fcntl
+import gzip
+import json
 import unittest
 import urllib
+import zipfile
 
+from functools import partial
 from hashlib import sha256
-from tempfile import NamedTemporaryFile
-from time import sleep
-from unittest.mock import patch
+from io import BytesIO
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from time import sleep, time
+from unittest.mock import call, patch
 
-from main import app, calculate_sri_on_file, hash_sum
+import brotli
+import fakeredis
+from moto.server import ThreadedMotoServer
+from PIL import Image
+from werkzeug.exceptions import HTTPException
+
+import prewarm
+from benchmark import compare, percentile
+from main import (
+    MAX_AGE,
+    CloudStorageCache,
+    DiskCache,
+    EncodeScheduler,
+    EncoderError,
+    ImageTooLarge,
+    JobQueue,
+    MagickEncoder,
+    MemoryCache,
+    OriginClient,
+    PillowEncoder,
+    QualityTarget,
+    SingleFlight,
+    TieredCache,
+    _set_failed_url,
+    app,
+    assets,
+    cache_open,
+    calculate_sri_on_file,
+    create_backend,
+    create_offload,
+    get_cached_url,
+    get_content_from_url,
+    get_quality,
+    get_url_hash,
+    hash_sum,
+    search_quality,
+    ssim,
+    warm_up,
+)
 from gcp_storage_emulator.server import create_server
 from flask_caching.contrib.googlecloudstoragecache import (
     GoogleCloudStorageCache as Cache,
 )
 
 TEST_BUCKET = "test"
+TEST_S3_BUCKET = "test-bucket"
+TEST_IMAGES_DIR = os.path.join(os.path.dirname(__file__), "..", "test_images")
 TEST_LOCAL_PNG = "static/tux.png"
 # sha256sum static/tux.png | head -c 64
 TEST_LOCAL_PNG_HASH = "4358b1e6137fd60a49ad90d108b73c0116738552d78cf4fceb56a89f044c342f"
@@ -301,6 +350,1266 @@ class SmokeTests(unittest.TestCase):
         sleep(5)
         self.assertEqual(cache.get("key"), None)
 
+    def test_cache_open(self):
+        cache = CloudStorageCache(bucket=TEST_BUCKET, anonymous=True)
+        data = os.urandom(1000)
+        cache.set("stream", data)
+        file, size = cache.open("stream")
+        with file:
+            self.assertEqual(size, 1000)
+            file.seek(100)
+            self.assertEqual(file.read(100), data[100:200])
+            file.seek(0)
+            self.assertEqual(file.read(), data)
+        cache.set("json", "message")
+        self.assertIsNone(cache.open("json"))
+        self.assertIsNone(cache.open("missing"))
+
+
+class StaticAssetTests(unittest.TestCase):
+    def test_assets(self):
+        client = app.test_client()
+        page = client.get("/").get_data(as_text=True)
+        with open("static/style.css", "rb") as file:
+            css = file.read()
+        for name in ("style.css", "javascript.js"):
+            asset = assets[name]
+            self.assertRegex(asset.name, r"^\w+\.[0-9a-f]{16}\.\w+$")
+            self.assertIn('"/assets/{}"'.format(asset.name), page)
+            self.assertIn('integrity="{}"'.format(asset.sri), page)
+            self.assertEqual(asset.sri, calculate_sri_on_file("static/" + name))
+        url = "/assets/" + assets["style.css"].name
+        response = client.get(url, headers={"Accept-Encoding": "gzip, br"})
+        self.assertEqual(response.content_encoding, "br")
+        self.assertEqual(brotli.decompress(response.data), css)
+        self.assertIn("immutable", response.headers["Cache-Control"])
+        self.assertEqual(response.headers["Vary"], "Accept-Encoding")
+        response = client.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(gzip.decompress(response.data), css)
+        response = client.get(url, headers={"Accept-Encoding": "identity"})
+        self.assertIsNone(response.content_encoding)
+        self.assertEqual(response.data, css)
+        response = client.get(url, headers={"If-None-Match": response.headers["ETag"]})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(client.get("/assets/style.css").status_code, 404)
+        self.assertEqual(client.get(url + "?x").status_code, 404)
+
+    def test_warm_up(self):
+        engine = PillowEncoder(fallback=FakeEncoder())
+        with patch("main.encoder", engine), patch("main.cache") as cache:
+            with patch.object(engine, "encode", wraps=engine.encode) as encode:
+                with self.assertLogs(level="WARNING"):
+                    warm_up()
+                encode.assert_called_once()
+            cache.has.assert_called_once()
+
+
+class LocalCacheTests(unittest.TestCase):
+    def test_memory_cache(self):
+        cache = MemoryCache(max_size=10, max_item_size=5)
+        self.assertTrue(cache.set("a", b"1234"))
+        self.assertTrue(cache.set("b", b"1234"))
+        self.assertEqual(cache.get("a"), b"1234")
+        # "b" is the least recently used one.
+        self.assertTrue(cache.set("c", b"1234"))
+        self.assertFalse(cache.has("b"))
+        self.assertTrue(cache.has("a"))
+        self.assertTrue(cache.has("c"))
+        self.assertFalse(cache.set("d", b"123456"))
+        self.assertIsNone(cache.get("d"))
+        cache.set("e", b"1", timeout=-1)
+        self.assertIsNone(cache.get("e"))
+
+    def test_disk_cache(self):
+        with TemporaryDirectory() as directory:
+            cache = DiskCache(directory, max_size=80)
+            self.assertTrue(cache.set("a", b"x" * 20))
+            self.assertTrue(cache.set("b", {"value": 1}))
+            self.assertEqual(cache.get("a"), b"x" * 20)
+            self.assertEqual(cache.get("b"), {"value": 1})
+            self.assertTrue(cache.has("a"))
+            self.assertFalse(cache.has("missing"))
+            os.utime(cache._filename("a"), (0, 0))
+            self.assertTrue(cache.set("c", b"y" * 20))
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(cache.get("c"), b"y" * 20)
+            self.assertEqual(DiskCache(directory, max_size=80)._size, cache._size)
+            file, size = cache.open("c")
+            with file:
+                self.assertEqual(size, 20)
+                file.seek(15)
+                self.assertEqual(file.read(), b"y" * 5)
+                file.seek(-10, os.SEEK_END)
+                self.assertEqual(file.read(100), b"y" * 10)
+            self.assertIsNone(cache.open("b"))
+            cache.set("d", b"1", timeout=-1)
+            self.assertIsNone(cache.get("d"))
+            self.assertIsNone(cache.open("d"))
+            self.assertTrue(cache.delete("c"))
+            self.assertFalse(cache.has("c"))
+
+    def test_disk_cache_shared_size(self):
+        # Two processes writing to the same directory.
+        with TemporaryDirectory() as directory:
+            first = DiskCache(directory, max_size=10000)
+            second = DiskCache(directory, max_size=10000)
+            for i in range(9):
+                first.set("first{}".format(i), b"x" * 1000)
+                second.set("second{}".format(i), b"x" * 1000)
+            size = sum(entry.stat().st_size for entry in os.scandir(directory))
+            self.assertLessEqual(size, 10000)
+
+    def test_disk_cache_lfu(self):
+        with TemporaryDirectory() as directory:
+            cache = DiskCache(directory, max_size=80, policy="lfu")
+            self.assertTrue(cache.set("a", b"x" * 20))
+            self.assertTrue(cache.set("b", b"x" * 20))
+            self.assertEqual(cache.get("a"), b"x" * 20)
+            os.utime(cache._filename("b"), None)
+            # "b" is used more recently but less frequently than "a".
+            self.assertTrue(cache.set("c", b"y" * 20))
+            self.assertTrue(cache.has("a"))
+            self.assertFalse(cache.has("b"))
+            self.assertTrue(cache.has("c"))
+            with self.assertRaises(ValueError):
+                DiskCache(directory, max_size=80, policy="fifo")
+
+    def test_tiered_cache(self):
+        memory = MemoryCache(max_size=100, max_item_size=100)
+        backend = MemoryCache(max_size=100, max_item_size=100)
+        cache = TieredCache([("memory", memory), ("backend", backend)])
+        backend.set("a", b"value")
+        self.assertEqual(cache.get("a"), b"value")
+        self.assertEqual(memory.get("a"), b"value")
+        self.assertEqual(cache.get("a"), b"value")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(
+            cache.stats(),
+            {
+                "memory": {"hits": 1, "misses": 2},
+                "backend": {"hits": 1, "misses": 1},
+            },
+        )
+        backend.set("large", b"x" * 20)
+        file, size = cache.open("large")
+        self.assertEqual((file.read(), size), (b"x" * 20, 20))
+        self.assertFalse(memory.has("large"))
+        cache.promote_size = 20
+        file, size = cache.open("large")
+        self.assertEqual((file.read(), size), (b"x" * 20, 20))
+        self.assertTrue(memory.has("large"))
+        self.assertTrue(cache.set("c", b"value"))
+        self.assertTrue(memory.has("c"))
+        self.assertTrue(backend.has("c"))
+        self.assertFalse(cache.add("c", b"other"))
+        self.assertTrue(cache.delete("c"))
+        self.assertFalse(cache.has("c"))
+
+
+class CacheConformance:
+    """The behaviour every cache backend must have."""
+
+    # Whether the store rejects an add of an existing key.
+    atomic_add = True
+
+    def make_cache(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.cache = self.make_cache()
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get("missing"))
+        self.assertTrue(self.cache.set("bytes", b"\x00value"))
+        self.assertEqual(self.cache.get("bytes"), b"\x00value")
+        self.assertTrue(self.cache.set("bytes", b"other"))
+        self.assertEqual(self.cache.get("bytes"), b"other")
+        record = {"status": "done", "error": None, "items": [1, 2]}
+        self.assertTrue(self.cache.set("record", record))
+        self.assertEqual(self.cache.get("record"), record)
+
+    def test_add(self):
+        self.assertTrue(self.cache.add("key", b"first"))
+        if self.atomic_add:
+            self.assertFalse(self.cache.add("key", b"second"))
+            self.assertEqual(self.cache.get("key"), b"first")
+
+    def test_has_delete(self):
+        self.assertFalse(self.cache.has("key"))
+        self.cache.set("key", b"value")
+        self.assertTrue(self.cache.has("key"))
+        self.assertTrue(self.cache.delete("key"))
+        self.assertFalse(self.cache.has("key"))
+        self.assertIsNone(self.cache.get("key"))
+
+    def test_expiry(self):
+        self.cache.set("key", b"value", timeout=1)
+        self.assertTrue(self.cache.has("key"))
+        sleep(1.5)
+        self.assertFalse(self.cache.has("key"))
+        self.assertIsNone(self.cache.get("key"))
+        self.assertIsNone(cache_open(self.cache, "key"))
+        self.assertTrue(self.cache.add("key", b"new"))
+
+    def test_open(self):
+        self.cache.set("bytes", b"x" * 1000)
+        file, size = cache_open(self.cache, "bytes")
+        with file:
+            self.assertEqual(size, 1000)
+            self.assertEqual(file.read(10), b"x" * 10)
+            self.assertEqual(file.read(), b"x" * 990)
+        self.assertIsNone(cache_open(self.cache, "missing"))
+        self.cache.set("record", {"value": 1})
+        self.assertIsNone(cache_open(self.cache, "record"))
+
+    def test_clear(self):
+        self.cache.set("a", b"1")
+        self.cache.set("b", {"value": 2})
+        self.assertTrue(self.cache.clear())
+        self.assertFalse(self.cache.has("a"))
+        self.assertFalse(self.cache.has("b"))
+
+
+class MemoryCacheConformanceTests(CacheConformance, unittest.TestCase):
+    def make_cache(self):
+        return MemoryCache(10**6, 10**6)
+
+
+class DiskCacheConformanceTests(CacheConformance, unittest.TestCase):
+    def make_cache(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        _name, cache = create_backend(
+            "file://{}?max_size=1000000&policy=lfu".format(directory.name)
+        )
+        self.assertEqual(cache.policy, "lfu")
+        return cache
+
+
+class TieredCacheConformanceTests(CacheConformance, unittest.TestCase):
+    def make_cache(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return TieredCache(
+            [
+                ("memory", MemoryCache(10**6, 10**6)),
+                ("disk", DiskCache(directory.name, 10**6)),
+            ]
+        )
+
+
+class RedisCacheConformanceTests(CacheConformance, unittest.TestCase):
+    def make_cache(self):
+        with patch("redis.Redis.from_url", return_value=fakeredis.FakeRedis()):
+            name, cache = create_backend("redis://localhost:6379/0")
+        self.assertEqual(name, "redis")
+        return cache
+
+
+class S3CacheConformanceTests(CacheConformance, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._server = ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+        cls._server.start()
+        cls.endpoint_url = "http://{}:{}".format(*cls._server.get_host_and_port())
+        cls._env = patch.dict(
+            os.environ, {"AWS_ACCESS_KEY_ID": "test", "AWS_SECRET_ACCESS_KEY": "test"}
+        )
+        cls._env.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._env.stop()
+        cls._server.stop()
+
+    def make_cache(self):
+        name, cache = create_backend(
+            "s3://{}/prefix/?endpoint_url={}&region_name=us-east-1".format(
+                TEST_S3_BUCKET, self.endpoint_url
+            )
+        )
+        self.assertEqual(name, "s3")
+        cache.client.create_bucket(Bucket=TEST_S3_BUCKET)
+        self.addCleanup(cache.clear)
+        return cache
+
+
+class CloudStorageCacheConformanceTests(CacheConformance, unittest.TestCase):
+    # The emulator ignores generation preconditions.
+    atomic_add = False
+
+    @classmethod
+    def setUpClass(cls):
+        cls._server = create_server(
+            "localhost", 9023, in_memory=True, default_bucket=TEST_BUCKET
+        )
+        cls._server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._server.stop()
+
+    def make_cache(self):
+        name, cache = create_backend("gs://{}/prefix/".format(TEST_BUCKET))
+        self.assertEqual(name, "gcs")
+        self.addCleanup(cache.clear)
+        return cache
+
+
+class CachedResponseTests(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        self.cache = MemoryCache(10**7, 10**7)
+
+    def test_etag(self):
+        with patch("main.cache", self.cache):
+            response = self.app.post("/api", data={"file": open(TEST_LOCAL_PNG, "rb")})
+            self.assertEqual(response.status_code, 302)
+            location = response.headers["Location"]
+            data_hash = location.rsplit("/", 1)[1]
+            response = self.app.get(location)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_etag(), (data_hash[:-5], False))
+            with patch.object(self.cache, "get") as cache_get:
+                response = self.app.get(
+                    location, headers={"If-None-Match": '"{}"'.format(data_hash[:-5])}
+                )
+                cache_get.assert_not_called()
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.get_etag(), (data_hash[:-5], False))
+            response = self.app.get("/{}.avif".format("0" * 64))
+            self.assertEqual(response.status_code, 404)
+
+    def test_range(self):
+        with TemporaryDirectory() as directory:
+            disk_cache = DiskCache(directory, 10**7)
+            data_hash = "{}.avif".format("1" * 64)
+            disk_cache.set(data_hash, bytes(range(256)))
+            with patch("main.cache", disk_cache):
+                response = self.app.get("/" + data_hash)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data, bytes(range(256)))
+                self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+                response = self.app.get(
+                    "/" + data_hash, headers={"Range": "bytes=10-19"}
+                )
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(response.data, bytes(range(10, 20)))
+                self.assertEqual(response.headers["Content-Range"], "bytes 10-19/256")
+                response = self.app.get(
+                    "/" + data_hash, headers={"Range": "bytes=1000-"}
+                )
+                self.assertEqual(response.status_code, 416)
+                response = self.app.head("/" + data_hash)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.content_length, 256)
+                self.assertEqual(response.data, b"")
+
+    def test_upload(self):
+        with open(TEST_LOCAL_PNG, "rb") as file:
+            body = file.read()
+        with patch("main.cache", self.cache), patch("main.hash_sum") as hash_sum:
+            response = self.app.post("/api", data={"file": (BytesIO(body), "tux.png")})
+            self.assertEqual(response.status_code, 302)
+            location = response.headers["Location"]
+            key = sha256(body)
+            key.update(b"50")
+            self.assertEqual(location, "/" + key.hexdigest() + ".avif")
+            # A raw body is the same image.
+            response = self.app.post(
+                "/api", data=body, headers={"Content-Type": "image/png"}
+            )
+            self.assertEqual(response.headers["Location"], location)
+            hash_sum.assert_not_called()
+            response = self.app.post(
+                "/api", data=body, headers={"Content-Type": "text/plain"}
+            )
+            self.assertEqual(response.status_code, 400)
+            with patch("main.POST_MAX_SIZE", len(body) - 1):
+                response = self.app.post(
+                    "/api", data=body, headers={"Content-Type": "image/png"}
+                )
+                self.assertEqual(response.status_code, 413)
+                response = self.app.post(
+                    "/api", data={"file": (BytesIO(body), "tux.png")}
+                )
+                self.assertEqual(response.status_code, 413)
+
+    def test_serve_cached(self):
+        with patch("main.cache", self.cache), patch("main.SERVE_CACHED", True):
+            response = self.app.post("/api", data={"file": open(TEST_LOCAL_PNG, "rb")})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data[4:12], b"ftypavif")
+            etag, _weak = response.get_etag()
+            response = self.app.post("/api", data={"file": open(TEST_LOCAL_PNG, "rb")})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_etag(), (etag, False))
+            response = self.app.post(
+                "/api",
+                data={"file": open(TEST_LOCAL_PNG, "rb")},
+                headers={"If-None-Match": '"{}"'.format(etag)},
+            )
+            self.assertEqual(response.status_code, 304)
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalOriginTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        handler = partial(QuietHandler, directory=os.path.dirname(TEST_IMAGES_DIR))
+        cls._server = ThreadingHTTPServer(("localhost", 0), handler)
+        cls._thread = threading.Thread(target=cls._server.serve_forever)
+        cls._thread.start()
+        cls.base_url = "http://localhost:{}/test_images/".format(
+            cls._server.server_port
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._server.shutdown()
+        cls._server.server_close()
+        cls._thread.join()
+
+    def test_get_content_from_url(self):
+        with app.test_request_context():
+            url = self.base_url + "test.jpg"
+            tempf, data_hash, validators = get_content_from_url(url)
+            with tempf:
+                self.assertEqual(data_hash.hexdigest(), TEST_NET_JPG_HASH)
+                with open(os.path.join(TEST_IMAGES_DIR, "test.jpg"), "rb") as file:
+                    self.assertEqual(tempf.read(), file.read())
+            self.assertIn("last_modified", validators)
+            headers = {"If-Modified-Since": validators["last_modified"]}
+            self.assertIsNone(get_content_from_url(url, headers))
+
+    def test_api_get(self):
+        response = app.test_client().get(
+            "/api?url={}".format(urllib.parse.quote(self.base_url + "test.png"))
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get("Content-Type"), "image/avif")
+        self.assertEqual(response.data[4:12], b"ftypavif")
+
+    def test_api_preset(self):
+        client = app.test_client()
+        url = "/api?url={}".format(urllib.parse.quote(self.base_url + "test.png"))
+        with patch("main.cache", MemoryCache(10**7, 10**7)):
+            default = client.get(url).headers["Location"]
+            fast = client.get(url + "&preset=fast").headers["Location"]
+            self.assertNotEqual(fast, default)
+            response = client.get(url + "&speed=9&tile_rows=1&tile_cols=1")
+            self.assertEqual(response.headers["Location"], fast)
+            self.assertEqual(client.get(url + "&preset=x").status_code, 400)
+
+    def test_metrics(self):
+        client = app.test_client()
+        tiers = TieredCache([("memory", MemoryCache(10**7, 10**7))])
+        with patch("main.cache", tiers):
+            client.get(
+                "/api?url={}&quality=70".format(
+                    urllib.parse.quote(self.base_url + "test.png")
+                )
+            )
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        metrics = response.get_data(as_text=True)
+        for name in [
+            'avif_request_seconds_count{endpoint="api_get",format="PNG",quality="70"}',
+            'avif_fetch_seconds_count{format="PNG",quality="70"}',
+            'avif_encode_seconds_count{format="PNG",quality="70"}',
+            'avif_probe_seconds_count{format="PNG",quality="70"}',
+            'avif_cache_lookups_total{kind="data",result="miss"}',
+            'avif_cache_tier_lookups_total{result="miss",tier="memory"}',
+            'avif_origin_requests_total{result="accepted"}',
+            "avif_origin_pool_connections{pool=",
+            'avif_output_bytes_total{format="PNG"}',
+            'avif_compression_ratio_count{format="PNG"}',
+            "avif_encode_slots_in_use ",
+            "avif_encodes_in_progress 0.0",
+        ]:
+            self.assertIn(name, metrics)
+        client.get("/api")
+        metrics = client.get("/metrics").get_data(as_text=True)
+        self.assertIn('avif_errors_total{code="400"}', metrics)
+
+    def test_widths(self):
+        client = app.test_client()
+        url = urllib.parse.quote(self.base_url + "test.png")
+        response = client.get("/api?url={}&width=64".format(url))
+        self.assertEqual(response.status_code, 200)
+        with Image.open(BytesIO(response.data)) as image:
+            self.assertEqual(image.width, 64)
+        response = client.get("/api?url={}&widths=64,128".format(url))
+        self.assertEqual(response.status_code, 501)
+        for query in ["width=64&widths=128", "width=0", "widths=64,64", "width=x"]:
+            response = client.get("/api?url={}&{}".format(url, query))
+            self.assertEqual(response.status_code, 400)
+        with patch("main.cache", MemoryCache(10**7, 10**7)):
+            response = client.get("/api?url={}&widths=64,128,original".format(url))
+            self.assertEqual(response.status_code, 200)
+            variants = response.json["variants"]
+            self.assertEqual(
+                [variant["width"] for variant in variants], [64, 128, "original"]
+            )
+            for variant in variants[:2]:
+                response = client.get(variant["image"])
+                with Image.open(BytesIO(response.data)) as image:
+                    self.assertEqual(image.width, variant["width"])
+            response = client.get("/api?url={}".format(url))
+            self.assertEqual(response.headers["Location"], variants[2]["image"])
+            with patch("main.get_content_from_url") as get_content:
+                response = client.get("/api?url={}&widths=128,64".format(url))
+                get_content.assert_not_called()
+            self.assertEqual(
+                [variant["image"] for variant in response.json["variants"]],
+                [variants[1]["image"], variants[0]["image"]],
+            )
+            response = client.post(
+                "/api", data={"file": open(TEST_LOCAL_PNG, "rb"), "widths": "32,64"}
+            )
+            self.assertEqual(len(response.json["variants"]), 2)
+
+    def wait_for_job(self, client, response):
+        self.assertEqual(response.status_code, 202)
+        location = response.headers["Location"]
+        for _ in range(300):
+            response = client.get(location)
+            self.assertEqual(response.status_code, 200)
+            if response.json["status"] not in ("pending", "running"):
+                break
+            sleep(0.1)
+        return response.json
+
+    def test_jobs(self):
+        client = app.test_client()
+        response = client.post("/api/jobs", data={"url": self.base_url + "test.png"})
+        self.assertEqual(response.status_code, 501)
+        with patch("main.cache", MemoryCache(10**7, 10**7)):
+            response = client.post(
+                "/api/jobs", data={"file": open(TEST_LOCAL_PNG, "rb"), "quality": "60"}
+            )
+            job = self.wait_for_job(client, response)
+            self.assertEqual(job["status"], "done")
+            response = client.get(job["image"])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data[4:12], b"ftypavif")
+            response = client.post(
+                "/api/jobs", data={"url": self.base_url + "test.png"}
+            )
+            job = self.wait_for_job(client, response)
+            self.assertEqual(job["status"], "done")
+            self.assertEqual(client.get(job["image"]).status_code, 200)
+            response = client.post(
+                "/api/jobs", data={"url": self.base_url + "missing.png"}
+            )
+            job = self.wait_for_job(client, response)
+            self.assertEqual(job["status"], "failed")
+            self.assertEqual(job["error"], 400)
+            response = client.post("/api/jobs", data={"url": "invalid"})
+            self.assertEqual(response.status_code, 400)
+            response = client.post("/api/jobs")
+            self.assertEqual(response.status_code, 400)
+            response = client.get("/api/jobs/" + "0" * 32)
+            self.assertEqual(response.status_code, 404)
+            response = client.get("/api/jobs/invalid")
+            self.assertEqual(response.status_code, 404)
+
+    def test_job_records(self):
+        # Two workers with their own local tiers over the same backend.
+        backend = MemoryCache(10**7, 10**7)
+        worker_a = TieredCache(
+            [("memory", MemoryCache(10**7, 10**7)), ("backend", backend)]
+        )
+        worker_b = TieredCache(
+            [("memory", MemoryCache(10**7, 10**7)), ("backend", backend)]
+        )
+        queue = JobQueue(1, 1, 60)
+        with patch("main.cache", worker_a):
+            queue.save({"id": "a" * 32, "status": "pending"})
+        with patch("main.cache", worker_b):
+            self.assertEqual(queue.get("a" * 32)["status"], "pending")
+        with patch("main.cache", worker_a):
+            queue.save({"id": "a" * 32, "status": "done"})
+        with patch("main.cache", worker_b):
+            self.assertEqual(queue.get("a" * 32)["status"], "done")
+
+    def test_job_initial_record(self):
+        queue = JobQueue(1, 1, 60)
+        with patch("main.cache", MemoryCache(10**7, 10**7)):
+            job = queue.submit(lambda pool: "image")
+            queue._threads.shutdown()
+            self.assertEqual(queue.get(job["id"])["status"], "done")
+        self.assertEqual(job["status"], "pending")
+        self.assertNotIn("image", job)
+
+    def test_batch(self):
+        client = app.test_client()
+        files = [
+            (open(TEST_LOCAL_PNG, "rb"), "tux.png"),
+            (open(TEST_LOCAL_PNG, "rb"), "tux-copy.png"),
+        ]
+        response = client.post("/api/batch?format=zip", data={"file": files})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get("Content-Type"), "application/zip")
+        with zipfile.ZipFile(BytesIO(response.data)) as archive:
+            manifest = json.loads(archive.read("manifest.json"))["items"]
+            self.assertEqual([item["status"] for item in manifest], ["done", "done"])
+            self.assertEqual(manifest[0]["file"], manifest[1]["file"])
+            self.assertEqual(len(archive.namelist()), 2)
+            self.assertEqual(archive.read(manifest[0]["file"])[4:12], b"ftypavif")
+        for name, value in (("BATCH_MAX_ITEMS", 1), ("BATCH_MAX_SIZE", 1000)):
+            files = [(open(TEST_LOCAL_PNG, "rb"), "tux.png") for _ in range(2)]
+            with patch("main." + name, value), patch("main.convert_source") as convert:
+                response = client.post("/api/batch?format=zip", data={"file": files})
+                convert.assert_not_called()
+            self.assertEqual(response.status_code, 413)
+        body = {
+            "items": [
+                {"url": self.base_url + "test.png", "quality": 40},
+                {"url": self.base_url + "test.gif"},
+                {"url": self.base_url + "missing.png"},
+            ],
+            "quality": 60,
+        }
+        response = client.post("/api/batch", json=body)
+        self.assertEqual(response.status_code, 501)
+        with patch("main.cache", MemoryCache(10**7, 10**7)):
+            response = client.post("/api/batch", json=body)
+            self.assertEqual(response.status_code, 200)
+            items = response.json["items"]
+            self.assertEqual(
+                [item["status"] for item in items], ["done", "done", "failed"]
+            )
+            self.assertEqual(items[2]["error"], 400)
+            for item in items[:2]:
+                self.assertEqual(client.get(item["image"]).status_code, 200)
+            response = client.post(
+                "/api/batch", json={"urls": [self.base_url + "test.png"]}
+            )
+            self.assertEqual(response.json["items"][0]["status"], "done")
+            response = client.post("/api/batch", json={"urls": ["invalid"]})
+            self.assertEqual(response.status_code, 400)
+            response = client.post("/api/batch", json={"urls": []})
+            self.assertEqual(response.status_code, 400)
+            response = client.post("/api/batch?format=tar", json=body)
+            self.assertEqual(response.status_code, 400)
+            with patch("main.BATCH_MAX_ITEMS", 2):
+                response = client.post("/api/batch", json=body)
+            self.assertEqual(response.status_code, 413)
+
+    def test_origin_client(self):
+        with TemporaryDirectory() as directory:
+            client = OriginClient(directory, 2, 1, (0.2, 1.0))
+            url = self.base_url + "test.png"
+            for _ in range(2):
+                with client.get(url) as response:
+                    self.assertEqual(response.status_code, 200)
+                    response.content
+            with app.test_request_context():
+                with client.get(url):
+                    with self.assertRaises(HTTPException) as context:
+                        with client.get(url):
+                            pass
+            self.assertEqual(context.exception.code, 503)
+            stats = client.stats()
+            self.assertEqual(stats["requests"], 3)
+            self.assertEqual(stats["rejected"], 1)
+            (pool,) = stats["pools"].values()
+            self.assertEqual(pool["requests"], 3)
+
+    def test_revalidation(self):
+        client = app.test_client()
+        url = "/api?url={}".format(urllib.parse.quote(self.base_url + "test.png"))
+        cache = MemoryCache(10**7, 10**7)
+        with patch("main.cache", cache):
+            response = client.get(url)
+            self.assertEqual(response.status_code, 302)
+            location = response.headers["Location"]
+            url_hash = get_url_hash(self.base_url + "test.png", "50")
+            record = json.loads(cache.get(url_hash))
+            self.assertEqual(location, "/" + record["data_hash"])
+            self.assertIn("last_modified", record)
+            with patch("main.URL_MAX_AGE", 0), patch("main.convert_widths") as convert:
+                response = client.get(url)
+                convert.assert_not_called()
+            self.assertEqual(response.headers["Location"], location)
+            self.assertGreater(
+                json.loads(cache.get(url_hash))["checked"], record["checked"]
+            )
+            # Without the image, the URL is downloaded again.
+            cache.delete(record["data_hash"])
+            with patch("main.URL_MAX_AGE", 0):
+                response = client.get(url)
+            self.assertEqual(response.headers["Location"], location)
+            self.assertTrue(cache.has(record["data_hash"]))
+
+    def test_url_record(self):
+        client = app.test_client()
+        url = "/api?url={}".format(urllib.parse.quote(self.base_url + "test.png"))
+        cache = MemoryCache(10**7, 10**7)
+        with patch("main.cache", cache):
+            with patch.object(cache, "has", wraps=cache.has) as has:
+                response = client.get(url)
+            url_hash = get_url_hash(self.base_url + "test.png", "50")
+            record = json.loads(cache.get(url_hash))
+            # The write is acknowledged by the cache, not checked after.
+            self.assertEqual(has.call_args_list.count(call(record["data_hash"])), 1)
+            image = cache.get(record["data_hash"])
+            self.assertEqual(response.headers["Location"], "/" + record["data_hash"])
+            self.assertEqual(record["size"], len(image))
+            self.assertEqual(record["source_mime"], "PNG")
+            self.assertAlmostEqual(record["expires"], record["created"] + MAX_AGE)
+            with patch("main._evicts_only_on_expiry", return_value=True):
+                with patch.object(cache, "has", wraps=cache.has) as has:
+                    response = client.get(url)
+                    has.assert_not_called()
+                self.assertEqual(response.status_code, 302)
+                # The image of the record has expired.
+                cache.set(url_hash, json.dumps(dict(record, expires=0)).encode())
+                with app.test_request_context():
+                    self.assertIsNone(get_cached_url(url_hash))
+            # Other backends may have evicted the image.
+            cache.delete(record["data_hash"])
+            with patch("main.convert_widths", return_value=[("x", None)]) as c:
+                client.get(url)
+                c.assert_called_once()
+
+    def test_prewarm(self):
+        cache = MemoryCache(10**7, 10**7)
+        with TemporaryDirectory() as directory, patch("main.cache", cache):
+            os.mkdir(os.path.join(directory, "images"))
+            for name in ("test.png", "test.gif", "test.bmp"):
+                with open(os.path.join(TEST_IMAGES_DIR, name), "rb") as src:
+                    with open(os.path.join(directory, "images", name), "wb") as dst:
+                        dst.write(src.read())
+            with open(os.path.join(directory, "images", "notes.txt"), "w") as file:
+                file.write("not an image")
+            urls = os.path.join(directory, "urls.txt")
+            with open(urls, "w") as file:
+                file.write("# comment\n\n{}test.jpg\n".format(self.base_url))
+            journal = os.path.join(directory, "journal.jsonl")
+            args = [os.path.join(directory, "images"), urls, "--journal", journal]
+            self.assertEqual(prewarm.run(args + ["--processes", "1"]), 0)
+            with open(journal) as file:
+                entries = [json.loads(line) for line in file]
+            self.assertEqual(len(entries), 4)
+            self.assertEqual({entry["status"] for entry in entries}, {"converted"})
+            for entry in entries:
+                self.assertTrue(cache.has(entry["image"]))
+            with patch("main.convert_file") as convert_file:
+                self.assertEqual(prewarm.run(args), 0)
+                os.unlink(journal)
+                self.assertEqual(prewarm.run(args), 0)
+                convert_file.assert_not_called()
+            with open(journal) as file:
+                entries = [json.loads(line) for line in file]
+            self.assertEqual({entry["status"] for entry in entries}, {"cached"})
+            # The same file and quality is served from the cache.
+            with open(os.path.join(TEST_IMAGES_DIR, "test.png"), "rb") as file:
+                response = app.test_client().post("/api", data={"file": file})
+            self.assertEqual(response.status_code, 302)
+            self.assertTrue(cache.has(response.headers["Location"][1:]))
+
+    def test_negative_cache(self):
+        client = app.test_client()
+        url = "/api?url={}".format(urllib.parse.quote(self.base_url + "missing.png"))
+        with patch("main.cache", MemoryCache(10**7, 10**7)):
+            response = client.get(url)
+            self.assertEqual(response.status_code, 400)
+            with patch("main.origin.get") as origin_get:
+                response = client.get(url)
+                origin_get.assert_not_called()
+            self.assertEqual(response.status_code, 400)
+
+    def test_negative_cache_expiry(self):
+        # A failure promoted into a local tier with a longer timeout.
+        backend = MemoryCache(10**7, 10**7)
+        tiers = TieredCache(
+            [
+                ("memory", MemoryCache(10**7, 10**7, default_timeout=3600)),
+                ("backend", backend),
+            ]
+        )
+        url_hash = get_url_hash(self.base_url + "missing.png")
+        with patch("main.cache", backend):
+            _set_failed_url(url_hash, 400)
+        with app.test_request_context(), patch("main.cache", tiers):
+            with self.assertRaises(HTTPException):
+                get_cached_url(url_hash)
+            with patch("main.time", return_value=time() + 61):
+                self.assertIsNone(get_cached_url(url_hash))
+
+    def test_get_content_from_url_errors(self):
+        with app.test_request_context():
+            with self.assertRaises(HTTPException) as context:
+                get_content_from_url(self.base_url + "missing.jpg")
+            self.assertEqual(context.exception.code, 400)
+            with self.assertRaises(HTTPException) as context:
+                get_content_from_url(self.base_url + "../README.md")
+            self.assertEqual(context.exception.code, 400)
+            with patch("main.GET_MAX_SIZE", 100):
+                with self.assertRaises(HTTPException) as context:
+                    get_content_from_url(self.base_url + "test.jpg")
+            self.assertEqual(context.exception.code, 406)
+
+
+class FakeEncoder:
+    name = "fake"
+
+    def encode_variants(self, source, variants):
+        raise EncoderError("fake")
+
+
+class EncoderTests(unittest.TestCase):
+    def test_pillow_encoder(self):
+        encoder = PillowEncoder(fallback=FakeEncoder())
+        mime, default_data, probe_time, _quality = encoder.encode(TEST_LOCAL_PNG)
+        self.assertEqual(mime, "PNG")
+        self.assertEqual(default_data[4:12], b"ftypavif")
+        self.assertGreater(probe_time, 0)
+        with open(TEST_LOCAL_PNG, "rb") as file:
+            result = encoder.encode(file, "0")
+            self.assertEqual((result.mime, result.data), (mime, default_data))
+        prev_len = 0
+        for quality in ["40", "85", "100"]:
+            data = encoder.encode(TEST_LOCAL_PNG, quality).data
+            self.assertLess(prev_len, len(data))
+            prev_len = len(data)
+
+    def test_pillow_encoder_variants(self):
+        encoder = PillowEncoder(fallback=FakeEncoder())
+        with patch("main.Image.open", wraps=Image.open) as image_open:
+            results = encoder.encode_variants(
+                TEST_LOCAL_PNG, [(32, None), (64, "60"), (None, None), (10000, None)]
+            )
+            image_open.assert_called_once()
+        with Image.open(TEST_LOCAL_PNG) as image:
+            size = image.size
+        sizes = []
+        for result in results:
+            with Image.open(BytesIO(result.data)) as image:
+                sizes.append(image.size)
+        self.assertEqual(sizes[0][0], 32)
+        self.assertEqual(sizes[1][0], 64)
+        self.assertEqual(sizes[2:], [size, size])
+
+    def test_pillow_encoder_fallback(self):
+        encoder = PillowEncoder(fallback=FakeEncoder())
+        with self.assertRaises(EncoderError):
+            encoder.encode(__file__)
+
+    def test_pillow_encoder_high_depth(self):
+        fallback = FakeEncoder()
+        encoder = PillowEncoder(fallback=fallback)
+        output = BytesIO()
+        Image.new("I;16", (16, 16), 1000).save(output, "PNG")
+        with patch.object(fallback, "encode_variants", return_value=["magick"]) as fb:
+            self.assertEqual(encoder.encode(output), "magick")
+            fb.assert_called_once()
+
+    def test_budget(self):
+        encoder = PillowEncoder(fallback=FakeEncoder())
+        gif = os.path.join(TEST_IMAGES_DIR, "test.gif")
+        with patch("main.MAX_MEGAPIXELS", 0.1):
+            # Too large images aren't passed to the fallback encoder.
+            with self.assertRaisesRegex(ImageTooLarge, "megapixels"):
+                encoder.encode(gif)
+        with patch("main.MAX_FRAMES", 5):
+            with self.assertRaisesRegex(ImageTooLarge, "6 frames"):
+                encoder.encode(gif)
+        with patch("main.MAX_FRAMES", 6):
+            self.assertEqual(encoder.encode(gif).mime, "GIF")
+        with patch("main.ENCODE_TIME_LIMIT", 0):
+            # Not passed to the fallback encoder either.
+            with self.assertRaisesRegex(ImageTooLarge, "longer than 0 s"):
+                encoder.encode(gif, "max_bytes=1000")
+        pages = "PDF 612 792\nPDF 612 792\n"
+        with patch("main._run", return_value=(pages, False)) as run:
+            with patch("main.MAX_PAGES", 1):
+                with self.assertRaisesRegex(ImageTooLarge, "2 pages"):
+                    MagickEncoder().encode(gif)
+            self.assertIn("-ping", run.call_args.args[0])
+        with patch("main.MAX_MEGAPIXELS", 0.1):
+            with open(gif, "rb") as file:
+                response = app.test_client().post("/api", data={"file": file})
+            self.assertEqual(response.status_code, 413)
+
+
+class EncoderOptionTests(unittest.TestCase):
+    def test_get_quality(self):
+        with app.test_request_context():
+            self.assertEqual(get_quality({}), "50")
+            self.assertEqual(
+                get_quality({"preset": "fast"}), "50;speed=9;tile_rows=1;tile_cols=1"
+            )
+            self.assertEqual(
+                get_quality({"preset": "fast", "speed": "05", "quality": "70"}),
+                "70;speed=5;tile_rows=1;tile_cols=1",
+            )
+            self.assertEqual(
+                get_quality({"max_bytes": "9000", "subsampling": "4:4:4"}),
+                "max_bytes=9000;subsampling=4:4:4",
+            )
+            with patch("main.DEFAULT_SPEED", "7"):
+                self.assertEqual(get_quality({}), "50;speed=7")
+                self.assertEqual(
+                    get_quality({"preset": "archive"}),
+                    get_quality({"preset": "archive", "speed": "2"}),
+                )
+            for values in (
+                {"preset": "slow"},
+                {"speed": "11"},
+                {"tile_rows": "-1"},
+                {"tile_cols": "x"},
+                {"subsampling": "4:1:1"},
+                {"depth": "16"},
+            ):
+                with self.assertRaises(HTTPException) as context:
+                    get_quality(values)
+                self.assertEqual(context.exception.code, 400)
+
+    def test_invalid_defaults(self):
+        for name, value in (("DEFAULT_SPEED", "11"), ("DEFAULT_DEPTH", "16")):
+            result = subprocess.run(
+                [sys.executable, "-c", "import main"],
+                capture_output=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=dict(os.environ, **{name: value}),
+                text=True,
+            )
+            self.assertNotEqual(result.returncode, 0)
+            self.assertIn(
+                "ValueError: Invalid {}: {}".format(name, value), result.stderr
+            )
+
+    def test_pillow_options(self):
+        encoder = PillowEncoder(fallback=FakeEncoder())
+        png = os.path.join(TEST_IMAGES_DIR, "test.png")
+        default = encoder.encode(png, "50")
+        result = encoder.encode(png, "50;speed=10;tile_cols=1;subsampling=4:4:4")
+        self.assertEqual(result.quality, "50;speed=10;tile_cols=1;subsampling=4:4:4")
+        self.assertNotEqual(result.data, default.data)
+        result = encoder.encode(png, "max_bytes=5000;speed=10")
+        self.assertRegex(result.quality, r"^\d+;speed=10$")
+        # Pillow encodes only 8 bits, so deeper images go to the fallback.
+        with self.assertRaisesRegex(EncoderError, "fake"):
+            encoder.encode(png, "50;depth=10")
+
+    def test_magick_options(self):
+        with patch("main._run", return_value=("", False)) as run:
+            MagickEncoder()._convert(
+                "test.png",
+                "PNG",
+                "50",
+                {"speed": "8", "subsampling": "4:4:4", "depth": "10"},
+            )
+        args = run.call_args.args[0]
+        for option in ("heic:speed=8", "heic:chroma=444"):
+            self.assertEqual(args[args.index(option) - 1], "-define")
+        self.assertEqual(args[args.index("-depth") + 1], "10")
+
+    def test_magick_single_variant(self):
+        with patch("main._run", return_value=("PNG 100 100\n", False)) as run:
+            MagickEncoder().encode_variants("test.png", [(32, "50")])
+        # Probed and converted, without decoding to a temporary file first.
+        self.assertEqual(run.call_count, 2)
+        args = run.call_args.args[0]
+        self.assertEqual(args[args.index("-resize") + 1], "32x>")
+        self.assertTrue(args[-1].startswith("avif:"))
+
+
+class QualitySearchTests(unittest.TestCase):
+    def test_search_quality(self):
+        probes = []
+
+        def encode(quality):
+            probes.append(int(quality))
+            return bytes(int(quality) * 10)
+
+        quality, data = search_quality(encode, QualityTarget("max_bytes", 700))
+        # The search stops within 5 % of the target.
+        self.assertEqual((quality, len(data)), ("68", 680))
+        self.assertEqual(probes, [50, 75, 62, 68])
+        probes.clear()
+        with patch("main.SEARCH_TOLERANCE", 0):
+            quality, _data = search_quality(encode, QualityTarget("max_bytes", 480))
+        self.assertEqual(quality, "48")
+        self.assertEqual(probes, [50, 25, 37, 43, 46, 48])
+        quality, data = search_quality(encode, QualityTarget("max_bytes", 5))
+        self.assertEqual((quality, len(data)), ("1", 10))
+
+    def test_ssim(self):
+        with Image.open(TEST_LOCAL_PNG) as image:
+            reference = image.convert("L")
+            output = BytesIO()
+            image.save(output, "AVIF", quality=100)
+            self.assertGreater(ssim(reference, output.getvalue()), 0.99)
+            quality, data = search_quality(
+                lambda quality: _encode(image, quality),
+                QualityTarget("ssim", 0.9),
+                reference,
+            )
+        self.assertGreaterEqual(ssim(reference, data), 0.9)
+        self.assertLess(int(quality), 100)
+
+    def test_api_targets(self):
+        client = app.test_client()
+        cache = MemoryCache(10**7, 10**7)
+        with patch("main.cache", cache):
+            response = client.post(
+                "/api",
+                data={"file": open(TEST_LOCAL_PNG, "rb"), "max_bytes": "5000"},
+                follow_redirects=True,
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data), 5000)
+            self.assertGreater(len(response.data), 4000)
+            data_hash = sha256()
+            with open(TEST_LOCAL_PNG, "rb") as file:
+                data_hash.update(file.read())
+            data_hash.update(b"max_bytes=5000")
+            key = data_hash.hexdigest() + ".avif"
+            quality = cache.get("quality-" + key)
+            self.assertIsNotNone(quality)
+            cache.delete(key)
+            with patch("main.search_quality") as search:
+                response = client.post(
+                    "/api",
+                    data={"file": open(TEST_LOCAL_PNG, "rb"), "max_bytes": "5000"},
+                )
+                search.assert_not_called()
+            self.assertEqual(response.status_code, 302)
+        for data in [
+            {"quality": "50", "max_bytes": "5000"},
+            {"max_bytes": "0"},
+            {"max_bytes": "many"},
+            {"target_ssim": "1.5"},
+            {"target_ssim": "high"},
+        ]:
+            data["file"] = open(TEST_LOCAL_PNG, "rb")
+            response = client.post("/api", data=data)
+            self.assertEqual(response.status_code, 400)
+
+
+def _encode(image, quality):
+    output = BytesIO()
+    image.save(output, "AVIF", quality=int(quality))
+    return output.getvalue()
+
+
+class SingleFlightTests(unittest.TestCase):
+    def test_same_process(self):
+        with TemporaryDirectory() as directory:
+            single_flight = SingleFlight(directory, timeout=10)
+            calls = []
+            results = []
+
+            def work(waited):
+                calls.append(waited)
+                sleep(0.5)
+                return "result"
+
+            threads = [
+                threading.Thread(
+                    target=lambda: results.append(single_flight.do("key", work))
+                )
+                for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(calls, [False])
+        self.assertEqual(results, ["result"] * 5)
+
+    def test_removed_lock_file(self):
+        with TemporaryDirectory() as directory:
+            single_flight = SingleFlight(directory, timeout=10)
+            flock = fcntl.flock
+            operations = []
+
+            def unlink_first(file, operation):
+                # The previous holder removes the file after it was opened.
+                if not operations:
+                    os.unlink(file.name)
+                operations.append(operation)
+                flock(file, operation)
+
+            with patch("main.fcntl.flock", side_effect=unlink_first):
+                waited = single_flight.do(
+                    "key", lambda waited: waited, MemoryCache(100, 100)
+                )
+            self.assertTrue(waited)
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_shared_cache(self):
+        shared_cache = MemoryCache(max_size=100, max_item_size=100)
+        with TemporaryDirectory() as directory:
+            first = SingleFlight(directory, timeout=10)
+            second = SingleFlight(directory, timeout=10)
+            started = threading.Event()
+            waits = []
+
+            def slow(waited):
+                started.set()
+                sleep(0.5)
+                return waited
+
+            thread = threading.Thread(target=first.do, args=("key", slow, shared_cache))
+            thread.start()
+            started.wait()
+            waits.append(second.do("key", lambda waited: waited, shared_cache))
+            thread.join()
+            self.assertEqual(waits, [True])
+            self.assertFalse(shared_cache.has("key.lease"))
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_encode_scheduler(self):
+        with TemporaryDirectory() as directory, app.test_request_context():
+            scheduler = EncodeScheduler(directory, 1, 1, timeout=10)
+            queued = threading.Event()
+
+            def wait_for_slot():
+                queued.set()
+                with scheduler.slot():
+                    pass
+
+            with scheduler.slot():
+                thread = threading.Thread(target=wait_for_slot)
+                thread.start()
+                queued.wait()
+                while scheduler.stats()["queued"] == 0:
+                    sleep(0.01)
+                self.assertEqual(scheduler.stats()["running"], 1)
+                with self.assertRaises(HTTPException) as context:
+                    with scheduler.slot():
+                        pass
+                self.assertEqual(context.exception.code, 503)
+                self.assertIn("Retry-After", dict(context.exception.get_headers()))
+            thread.join()
+            stats = scheduler.stats()
+            self.assertEqual(stats["encodes"], 2)
+            self.assertEqual(stats["rejected"], 1)
+            self.assertEqual(stats["running"], 0)
+            self.assertEqual(stats["queued"], 0)
+            self.assertGreater(stats["wait_time_max"], 0)
+
+    def test_lease_timeout(self):
+        shared_cache = MemoryCache(max_size=100, max_item_size=100)
+        shared_cache.add("key.lease", 1)
+        with TemporaryDirectory() as directory:
+            single_flight = SingleFlight(directory, timeout=0.5)
+            self.assertTrue(
+                single_flight.do("key", lambda waited: waited, shared_cache)
+            )
+        self.assertTrue(shared_cache.has("key.lease"))
+
+
+GEVENT_SCRIPT = """
+from gevent import monkey
+
+monkey.patch_all()
+
+import sys
+
+import gevent
+import main
+
+ticks = []
+
+
+def tick():
+    while True:
+        ticks.append(1)
+        gevent.sleep(0.001)
+
+
+ticker = gevent.spawn(tick)
+gevent.sleep(0)
+with open(sys.argv[1], "rb") as file:
+    response = main.app.test_client().post("/api", data={"file": file})
+ticker.kill()
+print(main.offload is not None, response.status_code, len(ticks))
+"""
+# Stands in for ImageMagick, identifying every input as a one-page PDF.
+FAKE_MAGICK = """#!{}
+import sys
+
+if sys.argv[1] == "identify":
+    print("PDF 612 792")
+else:
+    with open(sys.argv[-1].split(":", 1)[1], "wb") as file:
+        file.write(b"avif")
+"""
+
+
+class CooperativeWorkerTests(unittest.TestCase):
+    def test_offload(self):
+        self.assertIsNone(create_offload())
+        # gevent patches the whole process, so it's tested in another one.
+        result = self._run_gevent(TEST_LOCAL_PNG)
+        offloaded, status, ticks = result.stdout.split()
+        self.assertEqual((offloaded, status), ("True", "200"))
+        # Other greenlets ran while the image was encoded.
+        self.assertGreater(int(ticks), 5)
+
+    def test_offload_fallback(self):
+        with TemporaryDirectory() as directory:
+            magick = os.path.join(directory, "magick")
+            with open(magick, "w") as file:
+                file.write(FAKE_MAGICK.format(sys.executable))
+            os.chmod(magick, 0o755)
+            path = directory + os.pathsep + os.environ["PATH"]
+            result = self._run_gevent(
+                os.path.join(TEST_IMAGES_DIR, "test.pdf"), PATH=path
+            )
+        offloaded, status, _ticks = result.stdout.split()
+        self.assertEqual((offloaded, status), ("True", "200"))
+
+    def _run_gevent(self, filename, **env):
+        return subprocess.run(
+            [sys.executable, "-c", GEVENT_SCRIPT, filename],
+            capture_output=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=dict(os.environ, **env),
+            text=True,
+        )
+
+
+class BenchmarkTests(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3], 95), 3)
+
+    def test_compare(self):
+        baseline = {
+            "encode": [
+                {"file": "a.png", "quality": "50", "p50_ms": 100, "mb_per_s": 2.0},
+                {"file": "b.heic", "quality": "50", "error": "missing"},
+            ],
+            "load": {"p50_ms": 10, "p95_ms": 20, "p99_ms": 30, "rps": 100},
+        }
+        current = {
+            "encode": [
+                {"file": "a.png", "quality": "50", "p50_ms": 105, "mb_per_s": 1.5}
+            ],
+            "load": {"p50_ms": 10, "p95_ms": 30, "p99_ms": 30, "rps": 120},
+        }
+        regressions = compare(baseline, current, 0.1)
+        self.assertEqual(
+            [regression["metric"] for regression in regressions],
+            ["encode/a.png/q50/mb_per_s", "load/p95_ms"],
+        )
+        self.assertEqual(compare(baseline, baseline, 0.1), [])
+
 
 if __name__ == "__main__":
     unittest.main()
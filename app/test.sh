@@ -1,7 +1,7 @@
 #!/bin/sh
 set -e
 pip3 install --no-cache-dir --break-system-packages -r requirements-dev.txt
-coverage run --source=./ --omit=test.py test.py
+coverage run --source=./ --omit=test.py,benchmark.py test.py
 coverage report -m
 cd /
 cat > .coveragerc <<EOF